@@ -0,0 +1,270 @@
+"""
+Offline benchmark suite for preprocessing, training and inference.
+
+Generates a synthetic dataset (JPEGs with a realistic spread of sizes plus a matching
+labels.csv) and uses a small local stand-in for the TensorFlow Hub backbone, so no Drive and
+no network access are needed. It then measures, with the functions from dog_vision.py:
+* images/sec of process_image() and process_image_fast(),
+* images/sec of each create_data_batches() mode (including read-ahead), and of
+  create_data_batches_from_tfrecords(),
+* train_model() steps/sec,
+* predict latency and throughput at several batch sizes,
+and writes the results to a JSON file, so runs on different commits can be compared.
+
+Usage:
+  python benchmark.py --output bench_results/$(git rev-parse --short HEAD).json
+  python benchmark.py --compare bench_results/old.json --output bench_results/new.json
+"""
+
+import argparse
+import datetime
+import json
+import math
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from notebook_loader import load_notebook
+
+# Aspect ratios of the photos (width / height) and how often they come up
+ASPECT_RATIOS = [4 / 3, 3 / 4, 1., 16 / 9]
+ASPECT_RATIO_WEIGHTS = [0.55, 0.2, 0.15, 0.1]
+
+def make_synthetic_dataset(directory, num_images, num_breeds=120, seed=42):
+  """
+  Writes num_images JPEGs and a labels.csv to directory and returns the labels DataFrame.
+  The longer side of the images is around 500 pixels (log-normal, like the Kaggle photos) and
+  they are smooth with some noise, so they compress about like photos do.
+  """
+  rng = np.random.default_rng(seed)
+  train_dir = os.path.join(directory, "train")
+  os.makedirs(train_dir, exist_ok=True)
+  ids = []
+  for i in range(num_images):
+    longer_side = int(np.clip(rng.lognormal(np.log(500), 0.25), 100, 1500))
+    aspect_ratio = rng.choice(ASPECT_RATIOS, p=ASPECT_RATIO_WEIGHTS)
+    width, height = (longer_side, int(longer_side / aspect_ratio)) if aspect_ratio >= 1 else \
+                    (int(longer_side * aspect_ratio), longer_side)
+    # Blow up a tiny random image (smooth areas like a photo) and add a little noise
+    image = tf.image.resize(rng.uniform(0, 255, size=(8, 8, 3)).astype(np.float32), [height, width])
+    image = image + rng.normal(0, 8, size=(height, width, 3)).astype(np.float32)
+    image = tf.cast(tf.clip_by_value(image, 0, 255), tf.uint8)
+    image_id = f"{i:032x}"
+    tf.io.write_file(os.path.join(train_dir, image_id + ".jpg"), tf.io.encode_jpeg(image, quality=90))
+    ids.append(image_id)
+  labels_csv = pd.DataFrame({"id": ids,
+                             "breed": [f"breed_{index:03d}" for index in rng.integers(0, num_breeds, num_images)]})
+  labels_csv.to_csv(os.path.join(directory, "labels.csv"), index=False)
+  return labels_csv
+
+def make_stand_in_backbone(directory, img_size, num_outputs=1001, seed=42):
+  """
+  Saves a small convolutional network as a SavedModel which hub.KerasLayer can load from disk
+  instead of downloading MobileNetV2. It has the same output size (1001 logits) but is much cheaper.
+  """
+  tf.keras.utils.set_random_seed(seed)
+  backbone = tf.keras.Sequential([
+    tf.keras.layers.Conv2D(16, 3, strides=2, activation="relu", input_shape=[img_size, img_size, 3]),
+    tf.keras.layers.Conv2D(32, 3, strides=2, activation="relu"),
+    tf.keras.layers.Conv2D(64, 3, strides=2, activation="relu"),
+    tf.keras.layers.GlobalAveragePooling2D(),
+    tf.keras.layers.Dense(num_outputs)
+  ])
+  path = os.path.join(directory, "stand-in-backbone")
+  tf.saved_model.save(backbone, path)
+  return path
+
+def images_per_second(dataset, num_images, repeats=1):
+  """
+  Iterates through a dataset (repeats times, after one warm up pass) and returns images per second.
+  """
+  for _ in dataset:
+    pass
+  start = time.perf_counter()
+  for _ in range(repeats):
+    for _ in dataset:
+      pass
+  return num_images * repeats / (time.perf_counter() - start)
+
+class EpochTimer(tf.keras.callbacks.Callback):
+  """
+  Times every epoch of fit().
+  """
+  def on_train_begin(self, logs=None):
+    self.epoch_seconds = []
+
+  def on_epoch_begin(self, epoch, logs=None):
+    self.epoch_start = time.perf_counter()
+
+  def on_epoch_end(self, epoch, logs=None):
+    self.epoch_seconds.append(time.perf_counter() - self.epoch_start)
+
+def benchmark_preprocessing(notebook, filenames):
+  """
+  Measures images/sec of the single image preprocessing functions (one image at a time).
+  """
+  paths = tf.data.Dataset.from_tensor_slices(filenames)
+  return {name: images_per_second(paths.map(process_fn), len(filenames))
+          for name, process_fn in [("process_image", notebook.process_image),
+                                   ("process_image_fast", notebook.process_image_fast)]}
+
+def benchmark_data_batches(notebook, filenames, labels, cache_dir, tfrecord_dir):
+  """
+  Measures images/sec of every create_data_batches() mode on the training images, and of
+  create_data_batches_from_tfrecords() on the same images packed into TFRecord shards.
+  """
+  modes = {
+      "serial": dict(parallel=False, fast_decode=False, read_ahead=False),
+      "parallel": dict(parallel=True, fast_decode=False, read_ahead=False),
+      "parallel_non_deterministic": dict(parallel=True, deterministic=False, fast_decode=False, read_ahead=False),
+      "parallel_fast_decode": dict(parallel=True, fast_decode=True, read_ahead=False),
+      "parallel_read_ahead": dict(parallel=True, fast_decode=False, read_ahead=True),
+      "parallel_read_ahead_fast_decode": dict(parallel=True, fast_decode=True, read_ahead=True),
+  }
+  results = {name: images_per_second(notebook.create_data_batches(filenames, labels, **kwargs), len(filenames))
+             for name, kwargs in modes.items()}
+
+  # The first pass fills the cache, the timed passes only read it
+  start = time.perf_counter()
+  cached_data = notebook.create_data_batches(filenames, labels, parallel=True, cache_dir=cache_dir)
+  results["cache_fill"] = len(filenames) / (time.perf_counter() - start)
+  results["parallel_cached"] = images_per_second(cached_data, len(filenames))
+
+  # Packing the shards is a one off, like filling the cache
+  start = time.perf_counter()
+  file_pattern = notebook.write_tfrecord_shards(filenames, tfrecord_dir, labels=labels)
+  results["tfrecord_write"] = len(filenames) / (time.perf_counter() - start)
+  results["tfrecords"] = images_per_second(notebook.create_data_batches_from_tfrecords(file_pattern), len(filenames))
+  return results
+
+def benchmark_training(notebook, filenames, labels, epochs, logdir):
+  """
+  Measures train_model() steps/sec (leaving out the first epoch, which includes building the model).
+  """
+  from sklearn.model_selection import train_test_split
+  notebook.x_train, notebook.x_val, notebook.y_train, notebook.y_val = train_test_split(filenames, labels,
+                                                                                      test_size=0.2,
+                                                                                      random_state=42)
+  notebook.train_data = notebook.create_data_batches(notebook.x_train, notebook.y_train)
+  notebook.val_data = notebook.create_data_batches(notebook.x_val, notebook.y_val, valid_data=True)
+  # Logs go to a temporary directory, and every run trains for the same number of epochs (no early stopping)
+  notebook.create_tensorboard_callback = lambda: tf.keras.callbacks.TensorBoard(logdir)
+  timer = EpochTimer()
+  notebook.early_stopping = timer
+  notebook.NUM_EPOCHS = epochs
+  model = notebook.train_model()
+
+  steps_per_epoch = math.ceil(len(notebook.x_train) / notebook.BATCH_SIZE)
+  epoch_seconds = timer.epoch_seconds[1:] or timer.epoch_seconds
+  return model, {"steps_per_second": steps_per_epoch / np.mean(epoch_seconds),
+                 "first_epoch_seconds": timer.epoch_seconds[0]}
+
+def benchmark_predict(notebook, model, filenames, batch_sizes, num_runs=20):
+  """
+  Measures predict latency and throughput at several batch sizes (on already preprocessed images)
+  and end to end model.predict() throughput on test data batches.
+  """
+  images = np.concatenate(list(notebook.create_data_batches(filenames[:max(batch_sizes)], test_data=True).as_numpy_iterator()))
+  results = {}
+  for batch_size in batch_sizes:
+    batch = np.resize(images, [batch_size, *images.shape[1:]])
+    model.predict_on_batch(batch)
+    timings = []
+    for _ in range(num_runs):
+      start = time.perf_counter()
+      model.predict_on_batch(batch)
+      timings.append(time.perf_counter() - start)
+    results[f"batch_{batch_size}"] = {"p50_latency_ms": np.percentile(timings, 50) * 1000,
+                                      "p99_latency_ms": np.percentile(timings, 99) * 1000,
+                                      "images_per_second": batch_size / np.median(timings)}
+
+  test_data = notebook.create_data_batches(filenames, test_data=True)
+  model.predict(test_data, verbose=0)
+  start = time.perf_counter()
+  model.predict(test_data, verbose=0)
+  results["predict_end_to_end_images_per_second"] = len(filenames) / (time.perf_counter() - start)
+  return results
+
+def git_commit():
+  """
+  Returns the current git commit (or None outside a git checkout).
+  """
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def flatten(results, prefix=""):
+  """
+  Turns nested results into {"section.name": value} for comparing runs.
+  """
+  flat = {}
+  for key, value in results.items():
+    if isinstance(value, dict):
+      flat.update(flatten(value, prefix + key + "."))
+    elif isinstance(value, (int, float)):
+      flat[prefix + key] = value
+  return flat
+
+def main():
+  parser = argparse.ArgumentParser(description="Offline benchmarks for dog_vision.py.")
+  parser.add_argument("--num_images", type=int, default=512)
+  parser.add_argument("--epochs", type=int, default=3)
+  parser.add_argument("--batch_sizes", default="1,8,32,64")
+  parser.add_argument("--seed", type=int, default=42)
+  parser.add_argument("--output", default="bench_results.json")
+  parser.add_argument("--compare", help="Results JSON of an earlier run to compare against")
+  args = parser.parse_args()
+  batch_sizes = [int(batch_size) for batch_size in args.batch_sizes.split(",")]
+
+  with tempfile.TemporaryDirectory() as work_dir:
+    print("Making the synthetic dataset...")
+    labels_csv = make_synthetic_dataset(work_dir, args.num_images, seed=args.seed)
+    unique_breeds = np.unique(labels_csv["breed"])
+    notebook = load_notebook(unique_breeds=unique_breeds,
+                             MODEL_URL=make_stand_in_backbone(work_dir, 224, seed=args.seed))
+
+    filenames = [os.path.join(work_dir, "train", image_id + ".jpg") for image_id in labels_csv["id"]]
+    labels = np.searchsorted(unique_breeds, labels_csv["breed"]).astype(np.int32)
+    if not notebook.SPARSE_LABELS:
+      labels = labels[:, np.newaxis] == np.arange(len(unique_breeds))
+
+    results = {"preprocessing_images_per_second": benchmark_preprocessing(notebook, filenames)}
+    print(results)
+    results["data_batches_images_per_second"] = benchmark_data_batches(notebook, filenames, labels,
+                                                                       os.path.join(work_dir, "cache"),
+                                                                       os.path.join(work_dir, "tfrecords"))
+    print(results["data_batches_images_per_second"])
+    model, results["training"] = benchmark_training(notebook, filenames, labels, args.epochs,
+                                                    os.path.join(work_dir, "logs"))
+    print(results["training"])
+    results["predict"] = benchmark_predict(notebook, model, filenames, batch_sizes)
+    print(results["predict"])
+
+  report = {"commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(),
+            "tensorflow": tf.__version__,
+            "cpu_count": os.cpu_count(),
+            "config": vars(args),
+            "results": results}
+  os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+  with open(args.output, "w") as f:
+    json.dump(report, f, indent=2, default=float)
+  print(f"Saved benchmark results to: {args.output}")
+
+  if args.compare:
+    with open(args.compare) as f:
+      old_results = flatten(json.load(f)["results"])
+    comparison = pd.DataFrame({"before": pd.Series(old_results), "after": pd.Series(flatten(results))})
+    # Latencies should go down, everything else up
+    comparison["change"] = comparison["after"] / comparison["before"] - 1
+    print(comparison.to_string(float_format="{:.3f}".format))
+
+if __name__ == "__main__":
+  main()
@@ -65,26 +65,131 @@ Image("/content/drive/My Drive/Dog-vision/train/ffe2ca6c940cddfee68fa3cc6c63213f
 Let's get a list of all our images file pathnames
 """
 
-# Create pathnames from image ID's
-filenames = ["/content/drive/My Drive/Dog-vision/train/" + fname + ".jpg" for fname in labels_csv["id"]]
-filenames
+"""### Indexing the dataset once
+
+Listing a directory on the Drive mount is slow (and the order of `os.listdir()` can change between calls), and a corrupt or duplicated image can stall or skew a training run. So we scan each image directory **once** and write a manifest with, for every image:
+* its id, path and size in bytes,
+* a hash of its contents (to find duplicates),
+* its height and width and whether it decodes,
+* its breed index (for the training images).
+
+Everything after this (splitting, batching, the test submission) reads the manifest instead of the file system. Corrupt and duplicate images are left out of the training data by `load_manifest(exclude_unusable=True)`. The test data keeps every image, since the submission needs a row for every test id.
+
+The hashes in the manifests are remembered in `MANIFEST_HASHES`, so the caches further down don't have to read the files again to hash them.
+"""
 
-# Checking wheather number of filenames matches with actual number of image files
 import os
-if len(os.listdir("/content/drive/My Drive/Dog-vision/train")) == len(filenames):
+import hashlib
+import concurrent.futures
+import numpy as np
+
+# Where to keep the manifests
+TRAIN_MANIFEST_PATH = "/content/drive/My Drive/Dog-vision/train_manifest.csv" #@param {type:"string"}
+TEST_MANIFEST_PATH = "/content/drive/My Drive/Dog-vision/test_manifest.csv" #@param {type:"string"}
+
+# Leave corrupt and duplicate images out of the training data
+EXCLUDE_UNUSABLE_IMAGES = True #@param {type:"boolean"}
+
+# The SHA-1 of every image in the manifests loaded so far, by path
+MANIFEST_HASHES = {}
+
+# Create a function which reads one image and works out its manifest row
+def index_image(image_path):
+  """
+  Returns the id, path, byte size, content hash, height, width and decode-ok flag of an image file.
+  """
+  with tf.io.gfile.GFile(image_path, "rb") as f:
+    contents = f.read()
+  try:
+    height, width = tf.image.decode_jpeg(contents, channels=3).shape[:2]
+    decode_ok = True
+  except tf.errors.InvalidArgumentError:
+    height, width, decode_ok = -1, -1, False
+  return {"id": os.path.splitext(os.path.basename(image_path))[0],
+          "path": image_path,
+          "byte_size": len(contents),
+          "sha1": hashlib.sha1(contents).hexdigest(),
+          "height": height,
+          "width": width,
+          "decode_ok": decode_ok}
+
+# Create a function which scans an image directory once and writes its manifest
+def build_manifest(image_dir, manifest_path, labels_csv=None, num_threads=16):
+  """
+  Indexes every image in image_dir (reading files on num_threads threads, since Drive is slow
+  per file) and writes the manifest to manifest_path. With labels_csv the breed and breed index
+  (in np.unique(labels_csv["breed"]) order) of every image are added too.
+  """
+  # One listing, sorted so the order is the same every time
+  image_paths = [os.path.join(image_dir, fname) for fname in sorted(tf.io.gfile.listdir(image_dir))]
+  print(f"Indexing {len(image_paths)} images in: {image_dir}...")
+  with concurrent.futures.ThreadPoolExecutor(num_threads) as executor:
+    manifest = pd.DataFrame(list(executor.map(index_image, image_paths)))
+
+  # Only the first copy of an image is used
+  manifest["duplicate"] = manifest.duplicated("sha1")
+
+  if labels_csv is not None:
+    breeds = labels_csv.set_index("id")["breed"]
+    manifest["breed"] = manifest["id"].map(breeds)
+    manifest["breed_index"] = np.searchsorted(np.unique(labels_csv["breed"]), manifest["breed"].fillna(""))
+    # Images without a label can't be used for training
+    manifest.loc[manifest["breed"].isna(), "breed_index"] = -1
+    missing = len(set(labels_csv["id"]) - set(manifest["id"]))
+    if missing:
+      print(f"{missing} images in labels.csv are missing from {image_dir}")
+
+  manifest.to_csv(manifest_path, index=False)
+  print(f"Saved manifest to: {manifest_path} "
+        f"({(~manifest['decode_ok']).sum()} corrupt, {manifest['duplicate'].sum()} duplicates)")
+  return manifest
+
+# Create a function which loads a manifest (building it first if needed)
+def load_manifest(manifest_path, image_dir=None, labels_csv=None, rebuild=False, exclude_unusable=False):
+  """
+  Returns the rows of a manifest (only the images with a label, if it has labels). With
+  exclude_unusable=True images which don't decode or are duplicates are left out too.
+  If the manifest doesn't exist yet (or rebuild=True) it's built from image_dir.
+  """
+  if rebuild or not tf.io.gfile.exists(manifest_path):
+    manifest = build_manifest(image_dir, manifest_path, labels_csv=labels_csv)
+  else:
+    manifest = pd.read_csv(manifest_path, dtype={"id": str})
+  MANIFEST_HASHES.update(zip(manifest["path"], manifest["sha1"]))
+  usable = pd.Series(True, index=manifest.index)
+  if exclude_unusable:
+    usable &= manifest["decode_ok"] & ~manifest["duplicate"]
+  if "breed_index" in manifest:
+    usable &= manifest["breed_index"] >= 0
+  return manifest[usable].reset_index(drop=True)
+
+# Index the training images (only the first time, after that the manifest is read)
+train_manifest = load_manifest(TRAIN_MANIFEST_PATH,
+                               image_dir="/content/drive/My Drive/Dog-vision/train",
+                               labels_csv=labels_csv,
+                               exclude_unusable=EXCLUDE_UNUSABLE_IMAGES)
+train_manifest.head()
+
+# Use the paths from the manifest
+filenames = list(train_manifest["path"])
+filenames[:10]
+
+# Checking how many labelled images we can use
+if len(filenames) == len(labels_csv):
   print("Filenames match actual amount of files!")
 else:
-  print("Filenames do not match :(")
+  print(f"Using {len(filenames)} of the {len(labels_csv)} labelled images (the rest are missing, corrupt or duplicates)")
 
 # One more check
 Image(filenames[9000])
 
-labels_csv["breed"][9000]
+train_manifest["breed"][9000]
 
 """We now got our training image filepaths in a list, let's prepare our labels."""
 
 import numpy as np
-labels = labels_csv["breed"]
+# The labels of the images in the manifest (in the same order as filenames)
+labels = train_manifest["breed"]
 labels = np.array(labels)
 labels
 
@@ -96,8 +201,8 @@ if len(labels) == len(filenames):
 else:
   print("Do not match :(")
 
-# Find the unique label values
-unique_breeds = np.unique(labels)
+# Find the unique label values (from labels.csv, so a breed never goes missing if one of its images is left out)
+unique_breeds = np.unique(labels_csv["breed"])
 unique_breeds
 len(unique_breeds)
 
@@ -107,17 +212,24 @@ labels[0] == unique_breeds
 
 print(labels)
 
-# Turn every label into a boolean array
-boolean_labels = [label == unique_breeds for label in labels]
-boolean_labels[:]
+# Every label's index in unique_breeds comes from the manifest (one int32 per label instead of an array of 120 booleans)
+integer_labels = train_manifest["breed_index"].to_numpy(dtype=np.int32)
+integer_labels[:10]
+
+# Use integer labels with sparse categorical cross-entropy (boolean labels use categorical cross-entropy)
+SPARSE_LABELS = True #@param {type:"boolean"}
 
-len(boolean_labels)
+# Turn every label into a boolean array (all at once, from the integer labels), only if we train on them
+if not SPARSE_LABELS:
+  boolean_labels = integer_labels[:, np.newaxis] == np.arange(len(unique_breeds))
+  print(len(boolean_labels))
 
-# Example: Turning boolean array into integers
+# Example: Turning a boolean array into integers (just the first label)
+boolean_label = integer_labels[0] == np.arange(len(unique_breeds))
 print(labels[0]) #ORigina label
 print(np.where(unique_breeds == labels[0])) #index where label occurs
-print(boolean_labels[0].argmax()) #index where label occurs in boolean array
-print(boolean_labels[0].astype(int)) # there will be a 1 where the sample lable occurs
+print(boolean_label.argmax()) #index where label occurs in boolean array
+print(boolean_label.astype(int)) # there will be a 1 where the sample lable occurs
 
 filenames[:]
 
@@ -127,7 +239,7 @@ Since the dataset from Kaggle doesn't come with a validation set, let's create o
 
 #Setup x & y variables
 x = filenames
-y = boolean_labels
+y = integer_labels if SPARSE_LABELS else boolean_labels
 
 len(filenames)
 
@@ -174,22 +286,105 @@ tf.constant(image)[:2]
 # Define image size
 IMG_SIZE = 224
 
+# Set to a PipelineProfiler (see "Profiling the input pipeline and training") to time every preprocessing stage
+PROFILER = None
+
+# Create a function which gives the time a profiled stage starts at
+def start_profiling(after=None):
+  """
+  Returns the current time as a Tensor (once after is ready) if profiling is on, otherwise None.
+  """
+  if PROFILER is None:
+    return None
+  with tf.control_dependencies([after] if after is not None else []):
+    return tf.timestamp()
+
+# Create a function which records how long a stage of the pipeline took
+def profile_stage(stage, value, start):
+  """
+  Records with PROFILER that stage took from start until value was ready.
+  Returns value and the time it was ready (the start of the next stage).
+  """
+  if PROFILER is None or start is None:
+    return value, start
+  profiler = PROFILER
+  with tf.control_dependencies([value]):
+    end = tf.timestamp()
+  recorded = tf.py_function(lambda seconds: profiler.record_stage(stage, seconds.numpy()), [end - start], tf.float64)
+  # Make value wait for the recording, otherwise TensorFlow could skip it
+  with tf.control_dependencies([recorded]):
+    return tf.identity(value), end
+
 # Create a function for preprocessing images
 def process_image(image_path, img_size= IMG_SIZE):
   """
   Takes an iamge file and turn the image into a tensor.
   """
+  start = start_profiling()
   #Read an image file
   image = tf. io.read_file(image_path)
+  image, start = profile_stage("read_file", image, start)
+  return decode_image(image, img_size=img_size, start=start)
+
+# Create a function for preprocessing images which are already in memory (e.g. uploaded to a server)
+def decode_image(image, img_size=IMG_SIZE, start=None):
+  """
+  Takes the bytes of a jpeg image and turns them into a tensor, the same way as process_image().
+  """
+  if start is None:
+    start = start_profiling(after=image)
   #Turn th jpeg image into numerical Tensor with 3 colour RGB channel
   image = tf.image.decode_jpeg(image, channels=3)
+  image, start = profile_stage("decode_jpeg", image, start)
   #Convert the colour channels from 0-255 to 0-1
   image = tf.image.convert_image_dtype(image, tf.float32)
+  image, start = profile_stage("convert_image_dtype", image, start)
   #Resize the image to our desired values(224, 224)
-  image = tf.image.resize(image, size=[IMG_SIZE, IMG_SIZE])
+  image = tf.image.resize(image, size=[img_size, img_size])
+  image, start = profile_stage("resize", image, start)
 
   return image
 
+"""### A faster way to decode
+
+Most of the Kaggle photos are 500 pixels or more across, but we only keep 224x224 of them. JPEG decoders can shrink an image by 2, 4 or 8 while decoding (in the DCT domain), which skips most of the work of decoding the full image. So:
+1. Read the image size from the JPEG header (without decoding it).
+2. Pick the biggest shrink ratio which still leaves the image at least `img_size` pixels on its shorter side.
+3. Decode at that ratio, resize, and only then turn the pixels into float32 (on 224x224 pixels instead of the full image).
+
+We don't crop while decoding: the model is trained on the whole (squashed) image and cropping would change what it sees.
+"""
+
+import functools
+
+# Shrink ratios supported by the JPEG decoder
+JPEG_DECODE_RATIOS = [1, 2, 4, 8]
+
+def process_image_fast(image_path, img_size=IMG_SIZE):
+  """
+  Same as process_image() but decodes the JPEG at a reduced resolution when the image is
+  much bigger than img_size and converts to float32 after resizing.
+  """
+  return decode_image_fast(tf.io.read_file(image_path), img_size=img_size)
+
+def decode_image_fast(image, img_size=IMG_SIZE):
+  """
+  Same as decode_image() but with the faster decode of process_image_fast().
+  """
+  # Height and width from the JPEG header
+  shape = tf.image.extract_jpeg_shape(image)
+  shorter_side = tf.minimum(shape[0], shape[1])
+  # Index of the biggest ratio which doesn't shrink the shorter side below img_size
+  ratio_index = tf.reduce_sum(tf.cast(shorter_side >= img_size * tf.constant(JPEG_DECODE_RATIOS[1:]), tf.int32))
+  # The decode ratio has to be a constant, so make one decode branch per ratio
+  image = tf.switch_case(ratio_index,
+                         [functools.partial(tf.image.decode_jpeg, image, channels=3, ratio=ratio)
+                          for ratio in JPEG_DECODE_RATIOS])
+  # Resize the uint8 image (this gives float32 values from 0 to 255) and then scale to 0-1
+  image = tf.image.resize(image, size=[img_size, img_size])
+  return image / 255.
+
+
 """## Turning into batches (minibatches of size 32 is good)
 
 why batches?
@@ -200,11 +395,11 @@ we need our data in the form of Tensor tuples `(image, label)` for TensorFlow to
 """
 
 # Create a dimple function to return a tuple (image, label)
-def get_image_label(image_path, label):
+def get_image_label(image_path, label, process_fn=process_image):
   """
   Takes an image file path name and assosciated label, processes the image and return a tuple 
   """
-  image = process_image(image_path)
+  image = process_fn(image_path)
   return image, label
 
 # Demo of the above
@@ -215,46 +410,345 @@ def get_image_label(image_path, label):
 # Define the batch size, 32 is a good start
 BATCH_SIZE = 32
 
+# Decode images in parallel and prepare the next batch while the model is busy with the current one
+PARALLEL_PIPELINE = True #@param {type:"boolean"}
+
+# Decode big JPEGs at a reduced resolution with process_image_fast()
+FAST_DECODE = False #@param {type:"boolean"}
+
+# Let tf.data tune the number of parallel calls and the prefetch buffer size at runtime
+AUTOTUNE = tf.data.AUTOTUNE
+
+def apply_pipeline_options(data, deterministic=True, num_threads=None):
+  """
+  Sets the element ordering and thread-pool size used by a tf.data pipeline.
+  """
+  options = tf.data.Options()
+  # Non-deterministic order lets a fast image overtake a slow one instead of waiting for it
+  options.deterministic = deterministic
+  if num_threads:
+    # Give the pipeline its own pool of threads instead of sharing the global one with the model
+    options.threading.private_threadpool_size = num_threads
+  return data.with_options(options)
+
+"""### Reading files ahead of the decoder
+
+Every image comes from the Drive mount, where each `tf.io.read_file()` waits for a network round trip before the image can be decoded. Reading is mostly waiting, so it's better done on a pool of threads, well ahead of the decoder:
+* A `ReadAheadReader` keeps up to `max_in_flight` reads going at once, but stops starting new ones while more than `max_bytes` of read files are waiting to be decoded (so memory stays bounded).
+* With `deterministic=False` the files are handed to the decoder in the order their reads finish, so a slow file doesn't hold up the ones behind it.
+* Validation and test data keep their order (their predictions have to line up with the labels and filenames), but the files behind a slow one keep being read while it's waited for.
+"""
+
+import concurrent.futures
+import itertools
+import threading
+
+# Read files on a pool of threads ahead of decoding, instead of one tf.io.read_file() per image
+READ_AHEAD = False #@param {type:"boolean"}
+
+# Create a function which reads the bytes of a file
+def read_file_bytes(path):
+  """
+  Returns the contents of a file as bytes.
+  """
+  with tf.io.gfile.GFile(path, "rb") as f:
+    return f.read()
+
+class ReadAheadReader:
+  """
+  Reads files with read_fn on a pool of threads, with at most max_in_flight reads going at once,
+  and no new reads started while more than max_bytes of finished reads are waiting to be used.
+  """
+  def __init__(self, max_in_flight=32, max_bytes=256 * 2**20, read_fn=read_file_bytes):
+    self.max_in_flight = max_in_flight
+    self.max_bytes = max_bytes
+    self.read_fn = read_fn
+
+  def read(self, paths, ordered=True):
+    """
+    Yields (index in paths, bytes) for every path, in the order of paths if ordered is True,
+    otherwise in the order the reads finish.
+    """
+    lock = threading.Lock()
+    waiting_bytes = [0]
+
+    def read_one(index, path):
+      contents = self.read_fn(path)
+      with lock:
+        waiting_bytes[0] += len(contents)
+      return index, contents
+
+    def hand_over(index, contents):
+      with lock:
+        waiting_bytes[0] -= len(contents)
+      return index, contents
+
+    with concurrent.futures.ThreadPoolExecutor(self.max_in_flight) as pool:
+      remaining = enumerate(paths)
+      in_flight = set()
+      # Finished reads waiting for an earlier one (ordered only)
+      finished = {}
+      next_index = 0
+      while True:
+        room = self.max_in_flight - len(in_flight) if waiting_bytes[0] < self.max_bytes else 0
+        for index, path in itertools.islice(remaining, room):
+          in_flight.add(pool.submit(read_one, index, path))
+        # Reads are started in order, so with nothing in flight everything has been handed over
+        if not in_flight:
+          return
+        done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+          index, contents = future.result()
+          if ordered:
+            finished[index] = contents
+          else:
+            yield hand_over(index, contents)
+        while next_index in finished:
+          yield hand_over(next_index, finished.pop(next_index))
+          next_index += 1
+
+# Create a function which turns filepaths into a dataset of file contents read ahead of time
+def read_ahead_dataset(X, y=None, reader=None, ordered=True, shuffle=False):
+  """
+  Returns a dataset of the contents of the files in X (paired with their labels if y is given),
+  read by reader (a ReadAheadReader). With shuffle=True the files are read in a new random
+  order every time the dataset is iterated.
+  """
+  reader = reader or ReadAheadReader()
+  X = list(X)
+  y = np.asarray(y) if y is not None else None
+
+  def generate():
+    order = np.random.permutation(len(X)) if shuffle else np.arange(len(X))
+    for index, contents in reader.read([X[i] for i in order], ordered=ordered):
+      yield contents if y is None else (contents, y[order[index]])
+
+  contents_spec = tf.TensorSpec(shape=[], dtype=tf.string)
+  if y is None:
+    output_signature = contents_spec
+  else:
+    output_signature = (contents_spec, tf.TensorSpec(shape=y.shape[1:], dtype=tf.as_dtype(y.dtype)))
+  return tf.data.Dataset.from_generator(generate, output_signature=output_signature)
+
+"""### Caching preprocessed images
+
+Decoding and resizing every JPEG again on every epoch is wasted work, the result is the same each time. So the first time we see an image we save the preprocessed Tensor to local disk and afterwards we only read it back.
+
+Cached images are keyed by a hash of the image file plus the image size, so if an image changes or we pick a different `IMG_SIZE` it simply gets a new cache entry.
+"""
+
+import hashlib
+import json
+
+# Local directory to keep preprocessed images in (local disk is much faster than Drive), "" turns caching off
+PREPROCESSED_CACHE_DIR = "/content/dog-vision-cache" #@param {type:"string"}
+
+# Create a function which hashes the contents of an image file
+def file_content_hash(image_path):
+  """
+  Returns the SHA-1 hex digest of the contents of a file.
+  """
+  with tf.io.gfile.GFile(image_path, "rb") as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+# Create a function which gives the content hash of every file without reading the files again if it can
+def content_hashes(X, cache_dir=PREPROCESSED_CACHE_DIR):
+  """
+  Returns the SHA-1 of every file in X. Files in a manifest use the hash from it, other files
+  are hashed once and remembered (by size and modification time) in cache_dir/index.json.
+  """
+  hashes = [MANIFEST_HASHES.get(image_path) for image_path in X]
+  if all(hashes):
+    return hashes
+
+  index_path = os.path.join(cache_dir, "index.json")
+  index = {}
+  if tf.io.gfile.exists(index_path):
+    with tf.io.gfile.GFile(index_path) as f:
+      index = json.load(f)
+  for i, image_path in enumerate(X):
+    if hashes[i]:
+      continue
+    stat = tf.io.gfile.stat(image_path)
+    entry = index.get(image_path)
+    if entry is None or entry["length"] != stat.length or entry["mtime_nsec"] != stat.mtime_nsec:
+      entry = {"length": stat.length,
+               "mtime_nsec": stat.mtime_nsec,
+               "sha1": file_content_hash(image_path)}
+      index[image_path] = entry
+    hashes[i] = entry["sha1"]
+
+  tf.io.gfile.makedirs(cache_dir)
+  with tf.io.gfile.GFile(index_path, "w") as f:
+    json.dump(index, f)
+  return hashes
+
+# Create a function which makes sure every image has a preprocessed copy in the cache
+def cache_preprocessed_images(X, cache_dir=PREPROCESSED_CACHE_DIR, img_size=IMG_SIZE):
+  """
+  Preprocesses every image in X which isn't cached yet and returns the filepaths of
+  the cached Tensors, in the same order as X.
+  """
+  cache_paths = []
+  missing = []
+  queued = set()
+  for image_path, key in zip(X, content_hashes(X, cache_dir=cache_dir)):
+    # Spread the files over 256 shard directories so no single directory gets huge
+    cache_path = os.path.join(cache_dir, str(img_size), key[:2], key + ".tensor")
+    # Identical files share one cache entry, so only queue each entry once
+    if cache_path not in queued and not tf.io.gfile.exists(cache_path):
+      missing.append((image_path, cache_path))
+      queued.add(cache_path)
+    cache_paths.append(cache_path)
+
+  if missing:
+    print(f"Caching {len(missing)} preprocessed images in: {cache_dir}...")
+    for shard_dir in {os.path.dirname(cache_path) for _, cache_path in missing}:
+      tf.io.gfile.makedirs(shard_dir)
+
+    # Write to a temporary file first so an interrupted run never leaves a half written Tensor behind
+    def write_cached_image(image_path, cache_path):
+      temp_path = cache_path + ".tmp"
+      image = process_image(image_path, img_size=img_size)
+      with tf.control_dependencies([tf.io.write_file(temp_path, tf.io.serialize_tensor(image))]):
+        return tf.identity(temp_path), cache_path
+
+    sources, destinations = zip(*missing)
+    written = tf.data.Dataset.from_tensor_slices((list(sources), list(destinations)))
+    written = written.map(write_cached_image, num_parallel_calls=AUTOTUNE)
+    for temp_path, cache_path in written.as_numpy_iterator():
+      tf.io.gfile.rename(temp_path.decode(), cache_path.decode(), overwrite=True)
+
+  return cache_paths
+
+# Create a function which reads a preprocessed image back from the cache
+def load_cached_image(cache_path, img_size=IMG_SIZE):
+  """
+  Reads a cached image Tensor written by cache_preprocessed_images().
+  """
+  start = start_profiling()
+  image = tf.io.parse_tensor(tf.io.read_file(cache_path), out_type=tf.float32)
+  image, start = profile_stage("read_cache", image, start)
+  # The shape isn't stored in the graph, so tell TensorFlow what it is
+  return tf.ensure_shape(image, [img_size, img_size, 3])
+
+# Create a function which records when a batch comes out of the pipeline
+def profile_batch_ready(pipeline, *batch):
+  """
+  Records with PROFILER that a batch of the given pipeline ("train", "valid" or "test") is ready.
+  """
+  profiler = PROFILER
+  recorded = tf.py_function(lambda: profiler.record_batch_ready(pipeline), [], tf.float64)
+  with tf.control_dependencies([recorded]):
+    batch = tuple(tf.identity(tensor) for tensor in batch)
+  return batch if len(batch) > 1 else batch[0]
+
 # Create a function to turn data into batches
-def create_data_batches(X, y=None, batch_size=BATCH_SIZE, valid_data=False, test_data=False):
+def create_data_batches(X, y=None, batch_size=BATCH_SIZE, valid_data=False, test_data=False,
+                        parallel=PARALLEL_PIPELINE, deterministic=True, num_threads=None,
+                        cache_dir=None, fast_decode=FAST_DECODE, input_context=None,
+                        read_ahead=READ_AHEAD):
   """
   Creates batches of data out of image (X) and label (y) pairs.
   Shuffles the data if it's training data but doesn't shuffle if it's validation data.
   Also accepts test data as input (no labels).
+
+  With parallel=True images are decoded on several threads and batches are prefetched.
+  deterministic=False only applies to training data, validation and test batches always
+  keep the order of X so predictions line up with their labels and filenames.
+
+  With a cache_dir images are only decoded the first time they're seen, see
+  cache_preprocessed_images(). Otherwise fast_decode=True decodes with process_image_fast().
+
+  read_ahead=True (or a ReadAheadReader) reads the files on a pool of threads ahead of decoding,
+  see ReadAheadReader. It doesn't apply with a cache_dir.
+
+  input_context is given by strategy.distribute_datasets_from_function(): each worker then only
+  reads its own shard of X and batches of batch_size per replica, so the global batch size
+  is batch_size times the number of replicas.
   """
+  # None keeps the original one-image-at-a-time map
+  num_parallel_calls = AUTOTUNE if parallel else None
+
+  # Give every worker a different share of the files
+  if input_context is not None and input_context.num_input_pipelines > 1:
+    shard = slice(input_context.input_pipeline_id, None, input_context.num_input_pipelines)
+    X = X[shard]
+    if y is not None:
+      y = y[shard]
+
+  # Cached images only need reading back, not decoding and resizing
+  if cache_dir:
+    X = cache_preprocessed_images(X, cache_dir=cache_dir)
+    process_fn = load_cached_image
+  # The files are read by the reader, so only decode in the map
+  elif read_ahead:
+    reader = read_ahead if isinstance(read_ahead, ReadAheadReader) else ReadAheadReader()
+    process_fn = decode_image_fast if fast_decode else decode_image
+  elif fast_decode:
+    process_fn = process_image_fast
+  else:
+    process_fn = process_image
+  image_label_fn = functools.partial(get_image_label, process_fn=process_fn)
+  read_ahead = read_ahead and not cache_dir
+
   # If the data is a test dataset, we probably don't have have labels
   if test_data:
+    pipeline = "test"
     print("Creating test data batches...")
-    data = tf.data.Dataset.from_tensor_slices((tf.constant(X))) # only filepaths (no labels)
-    data_batch = data.map(process_image).batch(BATCH_SIZE)
-    return data_batch
+    if read_ahead:
+      data = read_ahead_dataset(X, reader=reader) # only file contents (no labels)
+    else:
+      data = tf.data.Dataset.from_tensor_slices((tf.constant(X))) # only filepaths (no labels)
+    data_batch = data.map(process_fn, num_parallel_calls=num_parallel_calls).batch(batch_size)
+    deterministic = True
   
   # If the data is a valid dataset, we don't need to shuffle it
   elif valid_data:
+    pipeline = "valid"
     print("Creating validation data batches...")
-    data = tf.data.Dataset.from_tensor_slices((tf.constant(X), # filepaths
-                                               tf.constant(y))) # labels
-    data_batch = data.map(get_image_label).batch(BATCH_SIZE)
-    return data_batch
+    if read_ahead:
+      data = read_ahead_dataset(X, y, reader=reader)
+    else:
+      data = tf.data.Dataset.from_tensor_slices((tf.constant(X), # filepaths
+                                                 tf.constant(y))) # labels
+    data_batch = data.map(image_label_fn, num_parallel_calls=num_parallel_calls).batch(batch_size)
+    deterministic = True
 
   else:
+    pipeline = "train"
     print("Creating training data batches...")
-    # Turn filepaths and labels into Tensors
-    data = tf.data.Dataset.from_tensor_slices((tf.constant(X),
-                                               tf.constant(y)))
-    # Shuffling pathnames and labels before mapping image processor function is faster than shuffling images
-    data = data.shuffle(buffer_size=len(X))
+    if read_ahead:
+      # The reader shuffles the filepaths itself, and hands over files as they arrive unless deterministic
+      data = read_ahead_dataset(X, y, reader=reader, ordered=deterministic, shuffle=True)
+    else:
+      # Turn filepaths and labels into Tensors
+      data = tf.data.Dataset.from_tensor_slices((tf.constant(X),
+                                                 tf.constant(y)))
+      # Shuffling pathnames and labels before mapping image processor function is faster than shuffling images
+      data = data.shuffle(buffer_size=len(X))
 
     # Create (image, label) tuples (this also turns the iamge path into a preprocessed image)
-    data = data.map(get_image_label)
+    data = data.map(image_label_fn, num_parallel_calls=num_parallel_calls)
 
     # Turn the training data into batches
-    data_batch = data.batch(BATCH_SIZE)
+    data_batch = data.batch(batch_size)
+
+  if PROFILER is not None:
+    # Note when each batch is ready, so ProfilerCallback can tell how long a step waited for it
+    data_batch = data_batch.map(functools.partial(profile_batch_ready, pipeline))
+
+  if parallel:
+    # Have the next batch ready by the time the model asks for it
+    data_batch = data_batch.prefetch(AUTOTUNE)
+    data_batch = apply_pipeline_options(data_batch,
+                                        deterministic=deterministic,
+                                        num_threads=num_threads)
   return data_batch
 
 # Create training and validation data batches
-train_data = create_data_batches(x_train, y_train)
-val_data = create_data_batches(x_val, y_val, valid_data= True)
+train_data = create_data_batches(x_train, y_train, cache_dir=PREPROCESSED_CACHE_DIR)
+val_data = create_data_batches(x_val, y_val, valid_data= True, cache_dir=PREPROCESSED_CACHE_DIR)
 
 # Check out the different attributes of our data batches
 train_data.element_spec, val_data.element_spec
@@ -264,6 +758,157 @@ train_data.element_spec, val_data.element_spec
 
 y[0]
 
+"""### How much does the parallel pipeline help?
+
+Let's time the serial and parallel pipelines on a set of synthetic JPEGs so the comparison doesn't depend on Drive being fast or slow that day.
+"""
+
+import time
+
+# Create a function which writes random JPEGs of different sizes to a directory
+def make_synthetic_jpegs(directory, num_images=256, min_size=200, max_size=600, seed=42):
+  """
+  Writes num_images random JPEG images to directory and returns their filepaths.
+  """
+  os.makedirs(directory, exist_ok=True)
+  rng = np.random.default_rng(seed)
+  filepaths = []
+  for i in range(num_images):
+    # Random height and width, like real photos which come in all sorts of sizes
+    height, width = rng.integers(min_size, max_size, size=2)
+    image = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    filepath = os.path.join(directory, f"synthetic_{i:05d}.jpg")
+    tf.io.write_file(filepath, tf.io.encode_jpeg(image))
+    filepaths.append(filepath)
+  return filepaths
+
+# Create a function which measures how fast a batched dataset can be consumed
+def images_per_second(data_batch, num_images):
+  """
+  Iterates through a batched dataset once and returns the number of images processed per second.
+  """
+  start = time.perf_counter()
+  for _ in data_batch:
+    pass
+  return num_images / (time.perf_counter() - start)
+
+# Make a synthetic dataset (labels borrowed from the real ones, they don't matter for timing)
+synthetic_filenames = make_synthetic_jpegs("/tmp/dog-vision-synthetic")
+synthetic_labels = y[:len(synthetic_filenames)]
+
+# Warm up the file system cache so the first mode doesn't pay for reading from disk
+images_per_second(create_data_batches(synthetic_filenames, test_data=True, parallel=False), len(synthetic_filenames))
+
+# Time each pipeline mode on the same images
+pipeline_modes = {
+    "serial": dict(parallel=False),
+    "parallel": dict(parallel=True),
+    "parallel (non-deterministic)": dict(parallel=True, deterministic=False),
+    "parallel (4 threads)": dict(parallel=True, num_threads=4),
+}
+pipeline_report = pd.DataFrame(
+    [{"mode": mode,
+      "images/sec": images_per_second(create_data_batches(synthetic_filenames, synthetic_labels, **kwargs),
+                                      len(synthetic_filenames))}
+     for mode, kwargs in pipeline_modes.items()])
+pipeline_report["speedup"] = pipeline_report["images/sec"] / pipeline_report["images/sec"][0]
+print(pipeline_report)
+
+"""### Does reading ahead help on slow storage?
+
+The synthetic files are on a local disk, where reads take microseconds, so reading ahead wouldn't show much. To see what happens on Drive we need a stand-in for it: `SlowFileSystem` reads the local files but waits `latency_ms` before every read, and `slow_latency_ms` for a small fraction of the files (like the odd file Drive takes much longer to fetch).
+
+Besides images/sec, let's look at the longest wait for a batch, that's where a slow file holding up the others shows.
+"""
+
+import random
+
+class SlowFileSystem:
+  """
+  Reads local files after waiting latency_ms, or slow_latency_ms for slow_fraction of the files
+  (the same files every time).
+  """
+  def __init__(self, latency_ms=20, slow_fraction=0.02, slow_latency_ms=500, seed=42):
+    self.latency_ms = latency_ms
+    self.slow_fraction = slow_fraction
+    self.slow_latency_ms = slow_latency_ms
+    self.seed = seed
+
+  def read(self, path):
+    slow = random.Random(f"{self.seed}-{path}").random() < self.slow_fraction
+    time.sleep((self.slow_latency_ms if slow else self.latency_ms) / 1000)
+    return read_file_bytes(path)
+
+# Create a function which measures how long each batch of a dataset takes to arrive
+def batch_waits(data_batch):
+  """
+  Iterates through a batched dataset once and returns the seconds waited for each batch.
+  """
+  waits = []
+  start = time.perf_counter()
+  for _ in data_batch:
+    now = time.perf_counter()
+    waits.append(now - start)
+    start = now
+  return np.array(waits)
+
+slow_file_system = SlowFileSystem()
+
+# One read in flight is the same as reading the files one at a time
+read_ahead_modes = {
+    "one read at a time": dict(read_ahead=ReadAheadReader(max_in_flight=1, read_fn=slow_file_system.read)),
+    "32 reads in flight": dict(read_ahead=ReadAheadReader(max_in_flight=32, read_fn=slow_file_system.read)),
+    "32 reads in flight (non-deterministic)": dict(read_ahead=ReadAheadReader(max_in_flight=32, read_fn=slow_file_system.read),
+                                                   deterministic=False),
+    "32 reads in flight (1 MB budget)": dict(read_ahead=ReadAheadReader(max_in_flight=32, max_bytes=2**20,
+                                                                        read_fn=slow_file_system.read)),
+}
+read_ahead_rows = []
+for mode, kwargs in read_ahead_modes.items():
+  waits = batch_waits(create_data_batches(synthetic_filenames, synthetic_labels, **kwargs))
+  read_ahead_rows.append({"mode": mode,
+                          "images/sec": len(synthetic_filenames) / waits.sum(),
+                          "longest batch wait (ms)": waits.max() * 1000})
+read_ahead_report = pd.DataFrame(read_ahead_rows)
+read_ahead_report["speedup"] = read_ahead_report["images/sec"] / read_ahead_report["images/sec"][0]
+print(read_ahead_report)
+
+"""### Does the fast decode change what the model sees?
+
+Before switching on `FAST_DECODE`, let's check how close its images are to the ones from `process_image()` and how much faster it is on real photos.
+"""
+
+# Create a function which compares process_image_fast() to process_image()
+def decode_parity_report(image_paths, model=None):
+  """
+  Compares the images (and the model's predictions, if a model is given) from the fast and
+  the original decode paths and times both of them.
+  """
+  original = create_data_batches(image_paths, test_data=True, fast_decode=False)
+  fast = create_data_batches(image_paths, test_data=True, fast_decode=True)
+
+  # Pixel differences (pixels are between 0 and 1)
+  differences = np.concatenate([np.abs(a - b).reshape(len(a), -1).mean(axis=1)
+                                for a, b in zip(original.as_numpy_iterator(), fast.as_numpy_iterator())])
+  report = {"mean pixel difference": differences.mean(),
+            "worst image pixel difference": differences.max()}
+
+  # Prediction differences
+  if model is not None:
+    original_preds = model.predict(original)
+    fast_preds = model.predict(fast)
+    report["same predicted label"] = np.mean(original_preds.argmax(axis=1) == fast_preds.argmax(axis=1))
+    report["mean probability difference"] = np.abs(original_preds - fast_preds).max(axis=1).mean()
+
+  # Throughput of each path
+  report["original images/sec"] = images_per_second(original, len(image_paths))
+  report["fast images/sec"] = images_per_second(fast, len(image_paths))
+  report["speedup"] = report["fast images/sec"] / report["original images/sec"]
+  return pd.Series(report)
+
+decode_parity_report(filenames[:256])
+
+
 """## Visyalizing Data Batches
 
 Our data is now in batches, however, these can be a little hard to understand/comprehend, let's visualize them!
@@ -271,6 +916,13 @@ Our data is now in batches, however, these can be a little hard to understand/co
 
 import matplotlib.pyplot as plt
 
+# Create a function which works out the breed index of a label (integer or boolean array)
+def get_label_index(label):
+  """
+  Returns the index in unique_breeds of an integer label or a boolean (one-hot) label.
+  """
+  return np.argmax(label) if np.ndim(label) else int(label)
+
 #Create a function for viewing images in a data batches
 def show_25_images(images, labels):
   """
@@ -285,7 +937,7 @@ def show_25_images(images, labels):
     # Display an image
     plt.imshow(images[i])
     # Add the image label as the title
-    plt.title(unique_breeds[labels[i].argmax()])
+    plt.title(unique_breeds[get_label_index(labels[i])])
     # Turn the grid lines off
     plt.axis("off")
 
@@ -297,6 +949,140 @@ show_25_images(train_images, train_labels)
 val_images, val_labels = next(train_data.as_numpy_iterator())
 show_25_images(val_images, val_labels)
 
+"""## Packing images into TFRecord shards
+
+Reading ~10,000 small JPEG files one at a time from Drive means paying the full network round trip for every file. Instead, we can pack the raw JPEG bytes (plus ids and labels) into a few big TFRecord files (shards) and read those sequentially, several shards at a time.
+
+Images are written to the shards round-robin (image 0 to shard 0, image 1 to shard 1, ...), so reading one record from each shard in turn gives the images back in their original order. Test batches also carry the id stored in each record, so every prediction is written next to the id of the image it came from.
+
+Each set of shards goes in its own directory, named after a hash of the images (their contents), labels and number of shards. Changing the split, the images or `NUM_TFRECORD_SHARDS` gives a new directory instead of reusing shards written from a different list.
+"""
+
+# Directory for the TFRecord shards and how many shards to split each set of images into
+TFRECORD_DIR = "/content/drive/My Drive/Dog-vision/tfrecords" #@param {type:"string"}
+NUM_TFRECORD_SHARDS = 16 #@param {type:"integer"}
+
+# What every record holds (label is -1 for test images)
+TFRECORD_FEATURES = {
+    "image": tf.io.FixedLenFeature([], tf.string),
+    "id": tf.io.FixedLenFeature([], tf.string),
+    "label": tf.io.FixedLenFeature([], tf.int64, default_value=-1),
+}
+
+# Name of the file written next to a complete set of shards
+TFRECORD_DONE_FILENAME = "done.json"
+
+# Create a function which packs images into TFRecord shards
+def write_tfrecord_shards(image_paths, output_dir, labels=None, prefix="train", num_shards=NUM_TFRECORD_SHARDS):
+  """
+  Writes the raw JPEG bytes, ids and labels (integer or boolean) of image_paths round-robin into
+  num_shards TFRecord files named {prefix}-00000-of-000NN.tfrecord and returns their file pattern.
+  A done.json file with the ids is written last, to mark the set as complete.
+  """
+  tf.io.gfile.makedirs(output_dir)
+  shard_paths = [os.path.join(output_dir, f"{prefix}-{shard:05d}-of-{num_shards:05d}.tfrecord")
+                 for shard in range(num_shards)]
+  writers = [tf.io.TFRecordWriter(shard_path) for shard_path in shard_paths]
+  print(f"Packing {len(image_paths)} images into {num_shards} shards in: {output_dir}...")
+  for i, image_path in enumerate(image_paths):
+    with tf.io.gfile.GFile(image_path, "rb") as f:
+      image = f.read()
+    feature = {
+        "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[image])),
+        "id": tf.train.Feature(bytes_list=tf.train.BytesList(
+            value=[os.path.splitext(os.path.basename(image_path))[0].encode()])),
+    }
+    if labels is not None:
+      feature["label"] = tf.train.Feature(int64_list=tf.train.Int64List(value=[get_label_index(labels[i])]))
+    writers[i % num_shards].write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+  for writer in writers:
+    writer.close()
+  with tf.io.gfile.GFile(os.path.join(output_dir, TFRECORD_DONE_FILENAME), "w") as f:
+    json.dump({"num_shards": num_shards,
+               "ids": [os.path.splitext(os.path.basename(path))[0] for path in image_paths]}, f)
+  return os.path.join(output_dir, f"{prefix}-*-of-{num_shards:05d}.tfrecord")
+
+# Create a function which finds (or writes) the shards of exactly one list of images
+def get_tfrecord_shards(image_paths, tfrecord_dir=TFRECORD_DIR, labels=None, prefix="train",
+                        num_shards=NUM_TFRECORD_SHARDS):
+  """
+  Returns the file pattern of the shards holding image_paths (and labels) in num_shards shards,
+  writing them first unless a complete set already exists. Each set lives in its own
+  directory keyed by the image contents, ids, labels and number of shards.
+  """
+  key = hashlib.sha1()
+  for image_path, image_hash in zip(image_paths, content_hashes(image_paths)):
+    key.update(f"{os.path.basename(image_path)} {image_hash}\n".encode())
+  if labels is not None:
+    key.update(np.ascontiguousarray(labels).tobytes())
+  key.update(str(num_shards).encode())
+  output_dir = os.path.join(tfrecord_dir, f"{prefix}-{key.hexdigest()[:16]}")
+  file_pattern = os.path.join(output_dir, f"{prefix}-*-of-{num_shards:05d}.tfrecord")
+
+  # Only a set with its done file (written after every shard) is complete
+  if not tf.io.gfile.exists(os.path.join(output_dir, TFRECORD_DONE_FILENAME)):
+    write_tfrecord_shards(image_paths, output_dir, labels=labels, prefix=prefix, num_shards=num_shards)
+  if len(tf.io.gfile.glob(file_pattern)) != num_shards:
+    raise ValueError(f"Expected {num_shards} shards matching {file_pattern}")
+  return file_pattern
+
+# Create a function which turns a record back into an (image, label, id) tuple
+def parse_tfrecord(record):
+  """
+  Parses a TFRecord written by write_tfrecord_shards() and preprocesses its image like process_image().
+  """
+  features = tf.io.parse_single_example(record, TFRECORD_FEATURES)
+  image = decode_image(features["image"])
+  label = tf.cast(features["label"], tf.int32)
+  if not SPARSE_LABELS:
+    label = tf.one_hot(label, len(unique_breeds))
+  return image, label, features["id"]
+
+# Create a function to turn TFRecord shards into batches
+def create_data_batches_from_tfrecords(file_pattern, batch_size=BATCH_SIZE, valid_data=False, test_data=False,
+                                       shuffle_buffer_size=2048, deterministic=True):
+  """
+  Same as create_data_batches() but reads images from TFRecord shards, all shards at once
+  with a parallel interleave. Training data is shuffled, validation and test data come back
+  in the order they were written. Test data batches are (images, ids) instead of (images, labels).
+  file_pattern should be the exact pattern from get_tfrecord_shards() or write_tfrecord_shards().
+  """
+  # Sorted, so shard 0 comes first
+  shard_paths = sorted(tf.io.gfile.glob(file_pattern))
+  files = tf.data.Dataset.from_tensor_slices(shard_paths)
+  training = not (valid_data or test_data)
+  if training:
+    print("Creating training data batches from TFRecords...")
+    files = files.shuffle(len(shard_paths))
+  else:
+    print(f"Creating {'test' if test_data else 'validation'} data batches from TFRecords...")
+    deterministic = True
+
+  # One record from each shard in turn, reading the shards in parallel
+  data = files.interleave(tf.data.TFRecordDataset,
+                          cycle_length=len(shard_paths),
+                          block_length=1,
+                          num_parallel_calls=AUTOTUNE,
+                          deterministic=deterministic)
+  if training:
+    # Shuffle the (small) raw records before decoding them
+    data = data.shuffle(buffer_size=shuffle_buffer_size)
+  data = data.map(parse_tfrecord, num_parallel_calls=AUTOTUNE, deterministic=deterministic)
+  if test_data:
+    data = data.map(lambda image, label, image_id: (image, image_id))
+  else:
+    data = data.map(lambda image, label, image_id: (image, label))
+  return data.batch(batch_size).prefetch(AUTOTUNE)
+
+# Read the training and validation images from TFRecord shards instead of one file at a time
+USE_TFRECORDS = False #@param {type:"boolean"}
+
+if USE_TFRECORDS:
+  # Only packs the images the first time (and again if the split changes)
+  train_data = create_data_batches_from_tfrecords(get_tfrecord_shards(x_train, labels=y_train, prefix="train"))
+  val_data = create_data_batches_from_tfrecords(get_tfrecord_shards(x_val, labels=y_val, prefix="valid"),
+                                                valid_data=True)
+
 """## Building a model
 
 Before we build a model, there a few things we need to define:
@@ -326,32 +1112,174 @@ Let's create a function that:
 - https://www.tensorflow.org/api_docs/python/tf/keras/applications/MobileNetV2
 """
 
+# Create a function which picks the loss for the kind of labels we're using
+def create_loss(sparse_labels=SPARSE_LABELS):
+  """
+  Returns sparse categorical cross-entropy for integer labels and categorical
+  cross-entropy for boolean (one-hot) labels.
+  """
+  if sparse_labels:
+    return tf.keras.losses.SparseCategoricalCrossentropy()
+  return tf.keras.losses.CategoricalCrossentropy()
+
 # Create a function which builds a Keras model
-def create_model(input_shaape = INPUT_SHAPE, output_shape = OUTPUT_SHAPE, model_url = MODEL_URL):
-  print("Building with:", MODEL_URL)
+def create_model(input_shape = INPUT_SHAPE, output_shape = OUTPUT_SHAPE, model_url = MODEL_URL,
+                 sparse_labels = SPARSE_LABELS, backbone_size = None):
+  """
+  With a backbone_size the images are resized to backbone_size x backbone_size before the
+  TensorFlow Hub layer, for backbones trained on smaller images than IMG_SIZE.
+  """
+  print("Building with:", model_url)
 
   #Setup the model layers
-  model = tf.keras.Sequential([
-    hub.KerasLayer(MODEL_URL), #Layer 1 (i/p layer)
-    tf.keras.layers.Dense(units = OUTPUT_SHAPE,
+  layers = [
+    hub.KerasLayer(model_url), #Layer 1 (i/p layer)
+    tf.keras.layers.Dense(units = output_shape,
                          activation = "softmax") #LAyer 2 (o/p layer)
-  ])
+  ]
+  if backbone_size:
+    layers.insert(0, tf.keras.layers.Resizing(backbone_size, backbone_size))
+  model = tf.keras.Sequential(layers)
 
   # Compile the model
   model.compile(
-      loss = tf.keras.losses.CategoricalCrossentropy(),
+      loss = create_loss(sparse_labels),
       optimizer = tf.keras.optimizers.Adam(),
       metrics = ["accuracy"]
   )
 
   #Build the model
-  model.build(INPUT_SHAPE)
+  model.build(input_shape)
 
   return model
 
 model = create_model()
 model.summary()
 
+"""## Picking the batch size
+
+32 is a good start, but the fastest batch size depends on the machine. So let's try increasing batch sizes for training steps and for predictions, measure images/sec and how much memory each one needs, and pick the fastest one which fits in a memory budget.
+
+The batch sizes we pick are saved next to the model by `save_model()` so predictions can use them later.
+"""
+
+import resource
+
+# Create a function which measures the memory in use right now
+def current_memory_mb():
+  """
+  Returns the GPU memory in use if there's a GPU, otherwise the resident memory of this process, in MB.
+  """
+  if tf.config.list_physical_devices("GPU"):
+    return tf.config.experimental.get_memory_info("GPU:0")["current"] / 1e6
+  try:
+    # Second number is the resident size in pages
+    with open("/proc/self/statm") as f:
+      return int(f.read().split()[1]) * resource.getpagesize() / 1e6
+  except OSError:
+    # No /proc (not Linux), fall back to the peak so far (in kilobytes on Linux, bytes on macOS)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+# Create a function which measures how much memory a piece of work needs
+def memory_used_mb(fn, baseline_mb=None, interval=0.005):
+  """
+  Runs fn() and returns the highest memory in use while it ran minus baseline_mb (what was in
+  use before it, by default), in MB. On CPU the memory is sampled every interval seconds on
+  another thread.
+  """
+  if baseline_mb is None:
+    baseline_mb = current_memory_mb()
+  if tf.config.list_physical_devices("GPU"):
+    tf.config.experimental.reset_memory_stats("GPU:0")
+    fn()
+    return tf.config.experimental.get_memory_info("GPU:0")["peak"] / 1e6 - baseline_mb
+
+  highest = [current_memory_mb()]
+  done = threading.Event()
+  def sample():
+    while not done.is_set():
+      highest[0] = max(highest[0], current_memory_mb())
+      done.wait(interval)
+  sampler = threading.Thread(target=sample, daemon=True)
+  sampler.start()
+  try:
+    fn()
+  finally:
+    done.set()
+    sampler.join()
+  return max(highest[0], current_memory_mb()) - baseline_mb
+
+# Create a function which tries different batch sizes
+def autotune_batch_size(X, y, batch_sizes=(16, 32, 64, 128, 256), memory_budget_mb=None, num_steps=5):
+  """
+  Measures images/sec and the memory used by training steps and predictions at each batch size
+  (smallest first, stopping once the memory budget is exceeded or memory runs out) and returns
+  the fastest "batch_size" and "predict_batch_size" within the budget, plus the measurements.
+  If no batch size fits, the smallest one which ran (or the smallest one tried) is used.
+  """
+  # Preprocess enough images once, so we only time the model
+  images, labels = next(iter(create_data_batches(X, y, valid_data=True).unbatch().batch(max(batch_sizes))))
+  model = create_model()
+  # Memory freed by a probe isn't always given back (and earlier probes' buffers stay around),
+  # so every probe is measured as its peak above what was in use before the first one
+  baseline_mb = current_memory_mb()
+  results = []
+  for mode in ["fit", "predict"]:
+    for batch_size in sorted(batch_sizes):
+      # Repeat the images if there aren't enough for this batch size
+      batch_indexes = np.arange(batch_size) % len(images)
+      batch_images, batch_labels = tf.gather(images, batch_indexes), tf.gather(labels, batch_indexes)
+      step = (lambda: model.train_on_batch(batch_images, batch_labels)) if mode == "fit" else \
+             (lambda: model.predict_on_batch(batch_images))
+      def timed_steps():
+        # The first step includes building the step function, so it's measured but not timed
+        step()
+        start = time.perf_counter()
+        for _ in range(num_steps):
+          step()
+        return (time.perf_counter() - start) / num_steps
+      try:
+        seconds = []
+        memory_mb = memory_used_mb(lambda: seconds.append(timed_steps()), baseline_mb=baseline_mb)
+      except tf.errors.ResourceExhaustedError:
+        print(f"{mode}: ran out of memory at batch size {batch_size}")
+        break
+      results.append({"mode": mode,
+                      "batch size": batch_size,
+                      "images/sec": batch_size / seconds[0],
+                      "memory used (MB)": memory_mb})
+      print(results[-1])
+      if memory_budget_mb and memory_mb > memory_budget_mb:
+        break
+
+  results = pd.DataFrame(results, columns=["mode", "batch size", "images/sec", "memory used (MB)"])
+  best = {}
+  for mode in ["fit", "predict"]:
+    ran = results[results["mode"] == mode]
+    within_budget = ran if not memory_budget_mb else ran[ran["memory used (MB)"] <= memory_budget_mb]
+    if len(within_budget):
+      best[mode] = int(within_budget.loc[within_budget["images/sec"].idxmax(), "batch size"])
+    else:
+      best[mode] = int(ran["batch size"].min()) if len(ran) else min(batch_sizes)
+      print(f"{mode}: no batch size fits in {memory_budget_mb} MB, using {best[mode]}")
+  return {"batch_size": best["fit"], "predict_batch_size": best["predict"], "measurements": results}
+
+# Find the best batch sizes (this takes a few minutes, so it's off by default)
+AUTOTUNE_BATCH_SIZE = False #@param {type:"boolean"}
+# How much memory a batch size may use on top of what the notebook already uses
+MEMORY_BUDGET_MB = 8000 #@param {type:"integer"}
+
+tuned_settings = {"batch_size": BATCH_SIZE, "predict_batch_size": BATCH_SIZE}
+if AUTOTUNE_BATCH_SIZE:
+  tuned_settings = autotune_batch_size(x_train, y_train, memory_budget_mb=MEMORY_BUDGET_MB)
+  print(tuned_settings["measurements"])
+  # Remake our data batches with the batch sizes we picked
+  train_data = create_data_batches(x_train, y_train, batch_size=tuned_settings["batch_size"],
+                                   cache_dir=PREPROCESSED_CACHE_DIR)
+  val_data = create_data_batches(x_val, y_val, batch_size=tuned_settings["predict_batch_size"], valid_data=True,
+                                 cache_dir=PREPROCESSED_CACHE_DIR)
+print("Batch sizes:", {name: tuned_settings[name] for name in ["batch_size", "predict_batch_size"]})
+
 """## Callbacks
 
 callbacks are helper functions a moedl can use during training to do such things, as saving progress or stop training early if a model stops imporving.
@@ -390,6 +1318,130 @@ https://www.tensorflow.org/api_docs/python/tf/keras/callbacks/EarlyStopping
 early_stopping = tf.keras.callbacks.EarlyStopping(monitor="val_accuracy",
                                                   patience=3)
 
+"""### Checkpoint callback
+
+Training for up to `NUM_EPOCHS` and only saving at the end means a preempted run loses everything. So we checkpoint every epoch:
+* The model weights, the optimizer state (Adam's moments) and the epoch counter go into a TensorFlow checkpoint, written in the background (asynchronously) so training doesn't wait for the disk.
+* The early stopping state (best value so far and how many epochs it's been waiting) goes into a small JSON file next to it.
+
+When training starts again with the same checkpoint directory it picks up from the latest checkpoint instead of epoch 0.
+
+The checkpoints of a run go in a subdirectory named after a hash of its training images (their contents and order), labels and model settings (`checkpoint_key()`). Changing `NUM_IMAGES`, the split or the backbone starts a new run instead of loading the old weights. `NUM_EPOCHS` isn't part of the key, so a run which trained for all its epochs can be trained for longer (the last checkpoint records the epoch it got to, and whether early stopping ended it, in which case there's nothing left to do).
+"""
+
+# Where to keep training checkpoints (one subdirectory per training run)
+CHECKPOINT_DIR = "/content/drive/My Drive/Dog-vision/checkpoints" #@param {type:"string"}
+
+# Create a function which identifies a training run by its data and settings
+def checkpoint_key(X, y, **settings):
+  """
+  Returns a short hash of the images in X (contents and order), the labels y, IMG_SIZE,
+  SPARSE_LABELS and any other settings (e.g. model_url=...), to name a run's checkpoint directory.
+  """
+  key = hashlib.sha1()
+  key.update("\n".join(content_hashes(X)).encode())
+  key.update(np.ascontiguousarray(y).tobytes())
+  settings = dict(settings, img_size=IMG_SIZE, sparse_labels=SPARSE_LABELS)
+  key.update(json.dumps(settings, sort_keys=True, default=str).encode())
+  return key.hexdigest()[:16]
+
+# Create a function which asks TensorFlow to write checkpoints in the background
+def async_checkpoint_options():
+  """
+  Returns checkpoint options which write asynchronously (synchronously on TensorFlow versions without it).
+  """
+  try:
+    return tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+  except TypeError:
+    return tf.train.CheckpointOptions()
+
+# Create a callback which saves and restores everything needed to resume training
+class ResumableCheckpoint(tf.keras.callbacks.Callback):
+  """
+  Saves the model, optimizer, epoch counter and EarlyStopping state every save_every epochs,
+  and at the end of training (with whether it stopped early).
+  Call restore(model, epochs) before fit() and pass the epoch it returns as initial_epoch.
+  Put it after early_stopping in the callbacks list (so it can put back the restored state
+  after EarlyStopping resets itself at the start of training).
+  """
+  def __init__(self, checkpoint_dir, early_stopping=None, save_every=1, max_to_keep=3):
+    super().__init__()
+    self.checkpoint_dir = checkpoint_dir
+    self.early_stopping = early_stopping if isinstance(early_stopping, tf.keras.callbacks.EarlyStopping) else None
+    self.save_every = save_every
+    self.max_to_keep = max_to_keep
+    # Number of epochs finished
+    self.epoch = tf.Variable(0, dtype=tf.int64, trainable=False)
+    self.manager = None
+    self.early_stopping_state = None
+    self.stopped_early = False
+
+  def create_manager(self, model):
+    checkpoint = tf.train.Checkpoint(model=model, optimizer=model.optimizer, epoch=self.epoch)
+    self.manager = tf.train.CheckpointManager(checkpoint, self.checkpoint_dir, max_to_keep=self.max_to_keep)
+
+  def restore(self, model, epochs=None):
+    """
+    Restores the latest checkpoint (if there is one) into model and returns the epoch to resume from:
+    the last epoch it finished, or epochs if it stopped early (so fit() has nothing left to do).
+    """
+    self.create_manager(model)
+    latest = self.manager.latest_checkpoint
+    if latest is None:
+      return 0
+    # Optimizer slots are created on the first step, their values are restored then
+    self.manager.checkpoint.restore(latest)
+    state_path = latest + ".early_stopping.json"
+    if tf.io.gfile.exists(state_path):
+      with tf.io.gfile.GFile(state_path) as f:
+        state = json.load(f)
+      self.stopped_early = state.pop("stopped_early", False)
+      self.early_stopping_state = state
+    print(f"Resuming from: {latest} (epoch {int(self.epoch.numpy())}"
+          f"{', stopped early' if self.stopped_early else ''})")
+    if self.stopped_early and epochs is not None:
+      return max(epochs, int(self.epoch.numpy()))
+    return int(self.epoch.numpy())
+
+  def on_train_begin(self, logs=None):
+    if self.manager is None:
+      self.create_manager(self.model)
+    # Number of epochs finished in this fit() call (or before it)
+    self.last_epoch = int(self.epoch.numpy())
+    if self.early_stopping and self.early_stopping_state:
+      for name, value in self.early_stopping_state.items():
+        setattr(self.early_stopping, name, value)
+
+  def save(self, epoch, stopped_early=False):
+    self.epoch.assign(epoch)
+    path = self.manager.save(checkpoint_number=epoch, options=async_checkpoint_options())
+    state = {"stopped_early": stopped_early}
+    if self.early_stopping:
+      state.update({"wait": self.early_stopping.wait,
+                    "best": float(self.early_stopping.best),
+                    "stopped_epoch": self.early_stopping.stopped_epoch})
+    with tf.io.gfile.GFile(path + ".early_stopping.json", "w") as f:
+      json.dump(state, f)
+    # Remove the EarlyStopping state of checkpoints the manager has deleted (past max_to_keep)
+    kept = {os.path.basename(checkpoint_path) for checkpoint_path in self.manager.checkpoints}
+    for state_path in tf.io.gfile.glob(os.path.join(self.checkpoint_dir, "*.early_stopping.json")):
+      if os.path.basename(state_path)[:-len(".early_stopping.json")] not in kept:
+        tf.io.gfile.remove(state_path)
+
+  def on_epoch_end(self, epoch, logs=None):
+    self.last_epoch = epoch + 1
+    if (epoch + 1) % self.save_every == 0:
+      self.save(epoch + 1)
+
+  def on_train_end(self, logs=None):
+    # Save the epoch actually reached, and whether training stopped early (a run which ran all its
+    # epochs can be resumed with a bigger NUM_EPOCHS, one which stopped early has nothing left to do)
+    if self.model.stop_training or self.epoch.numpy() < self.last_epoch:
+      self.save(self.last_epoch, stopped_early=bool(self.model.stop_training))
+    # Wait for the background writes to finish
+    if hasattr(self.manager.checkpoint, "sync"):
+      self.manager.checkpoint.sync()
+
 """## Training a model (on subset of data)
 
 Our first model is only going to train on 1000 images, to make sure everything is working. 
@@ -408,28 +1460,232 @@ print("GPU:", "True!" if tf.config.list_physical_devices("GPU")else "False!")
 * Return the model.
 """
 
+# Create a function which checks if this process is the one which should write logs and files
+def is_chief(strategy):
+  """
+  Returns True unless the strategy is multi-worker and this process isn't worker 0 (or the chief).
+  """
+  cluster_resolver = getattr(strategy, "cluster_resolver", None)
+  if cluster_resolver is None or cluster_resolver.task_type in (None, "chief"):
+    return True
+  return cluster_resolver.task_type == "worker" and cluster_resolver.task_id == 0
+
 # Building a function to train and return a trained model
-def train_model():
+def train_model(strategy=None, checkpoint_dir=None, model_url=MODEL_URL, backbone_size=None):
   """
   Trains a given model and returns the trained version.
+  With a distribution strategy (e.g. tf.distribute.MultiWorkerMirroredStrategy()) the model is
+  built in its scope and every worker trains on its own shard of x_train/x_val.
+  With a checkpoint_dir training is checkpointed every epoch (in a subdirectory named by
+  checkpoint_key()) and resumes from the latest checkpoint of the same data and settings.
+  model_url and backbone_size are passed to create_model().
   """
-  # Create a model
-  model = create_model()
-
-  # Create new TensorBoard session everytime we train a model
-  tensorboard = create_tensorboard_callback()
+  if strategy is None:
+    # Create a model
+    model = create_model(model_url=model_url, backbone_size=backbone_size)
+    model_train_data, model_val_data = train_data, val_data
+  else:
+    with strategy.scope():
+      model = create_model(model_url=model_url, backbone_size=backbone_size)
+    model_train_data = strategy.distribute_datasets_from_function(
+        lambda input_context: create_data_batches(x_train, y_train, input_context=input_context))
+    model_val_data = strategy.distribute_datasets_from_function(
+        lambda input_context: create_data_batches(x_val, y_val, valid_data=True, input_context=input_context))
+
+  # Create new TensorBoard session everytime we train a model (only one worker writes logs)
+  callbacks = [early_stopping]
+  if strategy is None or is_chief(strategy):
+    callbacks.insert(0, create_tensorboard_callback())
+
+  # Pick up from the latest checkpoint (every worker saves, but only the chief into checkpoint_dir)
+  initial_epoch = 0
+  if checkpoint_dir:
+    checkpoint_dir = os.path.join(checkpoint_dir, checkpoint_key(x_train, y_train, x_val=checkpoint_key(x_val, y_val),
+                                                                 model_url=model_url, backbone_size=backbone_size))
+    if strategy is not None and not is_chief(strategy):
+      checkpoint_dir = os.path.join(checkpoint_dir, f"worker-{strategy.cluster_resolver.task_id}")
+    checkpoint = ResumableCheckpoint(checkpoint_dir, early_stopping)
+    initial_epoch = checkpoint.restore(model, epochs=NUM_EPOCHS)
+    callbacks.append(checkpoint)
 
   # Fit the model to the data passing it the callabcks we created
-  model.fit(x = train_data,
+  model.fit(x = model_train_data,
            epochs = NUM_EPOCHS,
-           validation_data = val_data,
+           initial_epoch = initial_epoch,
+           validation_data = model_val_data,
            validation_freq = 1,
-           callbacks = [tensorboard, early_stopping])
+           callbacks = callbacks)
   # Return the fitted model
   return model
 
-# Fit the model to the data
-model = train_model()
+# Fit the model to the data (checkpointed, so running this again after a disconnect resumes training)
+model = train_model(checkpoint_dir=os.path.join(CHECKPOINT_DIR, "1000-images"))
+
+"""## Training only the Dense head on cached embeddings
+
+The MobileNetV2 layer from TensorFlow Hub isn't trainable, so it gives the same output for an image on every epoch. Instead of pushing every image through it again and again, we can:
+* Run each image through the backbone once and save its outputs (embeddings) to a `.npy` file.
+* Train only the Dense output layer on those saved embeddings (seconds instead of hours on a CPU).
+* Put the trained Dense layer on top of the backbone again, so the result is a normal model which works with `save_model()` and `load_model()`.
+"""
+
+# Directory to keep backbone outputs in (.npy files can be memory-mapped so they don't have to fit in RAM)
+EMBEDDING_CACHE_DIR = "/content/dog-vision-embeddings" #@param {type:"string"}
+
+# Create a function which builds the backbone on its own
+def create_feature_extractor(model_url=MODEL_URL):
+  """
+  Builds a model containing only the TensorFlow Hub layer, without the Dense output layer.
+  """
+  extractor = tf.keras.Sequential([hub.KerasLayer(model_url)])
+  extractor.build(INPUT_SHAPE)
+  return extractor
+
+# Create a function which runs the backbone once over a list of images and saves the outputs
+def cache_embeddings(X, cache_dir=EMBEDDING_CACHE_DIR, model_url=MODEL_URL):
+  """
+  Returns the backbone outputs for every image in X as a read-only memory-mapped array,
+  computing and saving them first if they aren't cached yet.
+  """
+  # The file name depends on the backbone, the image size and the contents of the images, so a different setup never reuses it
+  key = hashlib.sha1("\n".join([model_url, str(IMG_SIZE)] + content_hashes(X, cache_dir=cache_dir)).encode()).hexdigest()
+  embeddings_path = os.path.join(cache_dir, key + ".npy")
+
+  if not os.path.exists(embeddings_path):
+    print(f"Computing embeddings for {len(X)} images...")
+    predict_to_npy(create_feature_extractor(model_url), X, embeddings_path)
+
+  print(f"Loading embeddings from: {embeddings_path}")
+  return np.load(embeddings_path, mmap_mode="r")
+
+# Create a function which writes a model's outputs for a list of images to a .npy file
+def predict_to_npy(model, X, output_path):
+  """
+  Runs model over the images in X batch by batch and writes the outputs to a .npy file at output_path.
+  """
+  os.makedirs(os.path.dirname(output_path), exist_ok=True)
+  outputs = np.lib.format.open_memmap(output_path + ".tmp", mode="w+", dtype=np.float32,
+                                      shape=(len(X), model.output_shape[-1]))
+  start = 0
+  # Write batch by batch straight into the file, so the outputs never all sit in memory
+  if len(X):
+    for batch in create_data_batches(X, test_data=True):
+      batch_outputs = model.predict_on_batch(batch)
+      outputs[start:start + len(batch_outputs)] = batch_outputs
+      start += len(batch_outputs)
+  outputs.flush()
+  del outputs
+  # Only make the file visible once it's complete
+  os.replace(output_path + ".tmp", output_path)
+  return output_path
+
+# Create a function which turns (memory-mapped) embeddings into batches without loading them all
+def embedding_batches(embeddings, labels, batch_size=BATCH_SIZE, shuffle=False):
+  """
+  Returns a dataset of (embeddings, labels) batches which reads one batch at a time from embeddings
+  (e.g. the memory-mapped array from cache_embeddings()). shuffle=True shuffles on every pass.
+  """
+  labels = np.asarray(labels)
+
+  def generate():
+    order = np.random.permutation(len(embeddings)) if shuffle else np.arange(len(embeddings))
+    for start in range(0, len(order), batch_size):
+      # Sorted rows read from the file in one sweep
+      rows = np.sort(order[start:start + batch_size])
+      yield np.asarray(embeddings[rows], dtype=np.float32), labels[rows]
+
+  output_signature = (tf.TensorSpec(shape=[None, embeddings.shape[1]], dtype=tf.float32),
+                      tf.TensorSpec(shape=[None] + list(labels.shape[1:]), dtype=tf.as_dtype(labels.dtype)))
+  return tf.data.Dataset.from_generator(generate, output_signature=output_signature).prefetch(AUTOTUNE)
+
+# Create a function which trains the Dense output layer on cached embeddings
+def train_head_on_embeddings(train_embeddings, y_train, val_embeddings=None, y_val=None):
+  """
+  Trains the Dense output layer on cached embeddings and returns it on top of the backbone,
+  built with create_model() so it can be saved and loaded like any other model.
+  """
+  # The same output layer and training setup as create_model(), without the backbone in front
+  head = tf.keras.Sequential([
+    tf.keras.layers.Dense(units = OUTPUT_SHAPE,
+                          activation = "softmax")
+  ])
+  head.compile(
+      loss = create_loss(),
+      optimizer = tf.keras.optimizers.Adam(),
+      metrics = ["accuracy"]
+  )
+
+  # Read from the (memory-mapped) embeddings a batch at a time instead of loading them all into memory
+  train_embedding_data = embedding_batches(train_embeddings, y_train, shuffle=True)
+
+  # Monitor validation accuracy if we have a validation set, otherwise training accuracy (like the full model)
+  if val_embeddings is not None:
+    val_embedding_data = embedding_batches(val_embeddings, y_val)
+    head_early_stopping = tf.keras.callbacks.EarlyStopping(monitor="val_accuracy",
+                                                           patience=3)
+  else:
+    val_embedding_data = None
+    head_early_stopping = tf.keras.callbacks.EarlyStopping(monitor="accuracy",
+                                                           patience=3)
+
+  head.fit(x = train_embedding_data,
+           epochs = NUM_EPOCHS,
+           validation_data = val_embedding_data,
+           callbacks = [create_tensorboard_callback(), head_early_stopping])
+
+  # Copy the trained output layer into a full model (backbone + output layer)
+  model = create_model()
+  model.layers[-1].set_weights(head.layers[-1].get_weights())
+  return model
+
+# Compute the embeddings once (the next runs load them straight from disk)
+train_embeddings = cache_embeddings(x_train)
+val_embeddings = cache_embeddings(x_val)
+
+# Train the head and check the full model does as well as the one we trained on images
+head_model = train_head_on_embeddings(train_embeddings, y_train, val_embeddings, y_val)
+head_model.evaluate(val_data)
+
+# Now that we have a trained model, check fast decoding doesn't change its predictions
+decode_parity_report(x_val, model=model)
+
+"""## Finding similar dogs
+
+The backbone's embeddings put images which look alike close together, so the images with the most similar embeddings to a new image are the most similar looking dogs (and very similar ones are likely duplicates).
+
+Comparing a query with every embedding gets slow as the number of images grows, so `similarity_index.py` has an approximate nearest neighbour index (`IVFIndex`):
+* k-means splits the embeddings into groups (lists).
+* A query is only compared with the embeddings in the `nprobe` lists closest to it.
+* More `nprobe` = more accurate but slower, the benchmark below shows the trade-off against exact search.
+"""
+
+from similarity_index import IVFIndex, recall_latency_benchmark
+
+# The feature vector version of MobileNetV2 outputs 1280 features instead of the 1001 ImageNet classes
+FEATURE_VECTOR_URL = "https://tfhub.dev/google/imagenet/mobilenet_v2_130_224/feature_vector/4"
+SIMILARITY_INDEX_DIR = "/content/dog-vision-similarity-index" #@param {type:"string"}
+
+# Embed every training image (cached, so this only runs the backbone once)
+all_embeddings = cache_embeddings(filenames, model_url=FEATURE_VECTOR_URL)
+image_ids = [os.path.splitext(os.path.basename(fname))[0] for fname in filenames]
+
+# Build the index (about sqrt(number of images) lists) and save it so it can be memory-mapped later
+similarity_index = IVFIndex(dim=all_embeddings.shape[1], num_lists=int(np.sqrt(len(all_embeddings))))
+similarity_index.train(all_embeddings)
+similarity_index.add(all_embeddings, image_ids, list(labels))
+similarity_index.save(SIMILARITY_INDEX_DIR)
+
+# Compare recall and speed against exact search on 200 of the training images
+pd.DataFrame(recall_latency_benchmark(IVFIndex.load(SIMILARITY_INDEX_DIR), all_embeddings[:200], k=10))
+
+# Find the 6 most similar dogs to the first training image (the first result is the image itself)
+similar_ids, similar_breeds, similarities = similarity_index.search(all_embeddings[:1], k=6, nprobe=8)
+plt.figure(figsize=(15, 3))
+for i, (image_id, breed, similarity) in enumerate(zip(similar_ids[0], similar_breeds[0], similarities[0])):
+  plt.subplot(1, 6, i+1)
+  plt.imshow(plt.imread(filenames[image_ids.index(image_id)]))
+  plt.title(f"{breed}\n{similarity:.2f}")
+  plt.axis("off")
 
 """### Checking the TensorBoard logs
 
@@ -439,6 +1695,169 @@ The TensorBoard magic function (`%tensorboard`) will access the logs directory w
 # Commented out IPython magic to ensure Python compatibility.
 # %tensorboard --logdir drive/My\ Drive/Dog-vision/logs
 
+"""## Profiling the input pipeline and training
+
+When a run is slow, is it reading files from Drive, decoding JPEGs, resizing, batching or the MobileNetV2 forward pass? Profiling is opt-in (it slows things down a little):
+* Setting `PROFILER` makes `process_image()` (and the other preprocessing functions) record how long each stage takes, and `create_data_batches()` record when each batch is ready. Datasets have to be created after `PROFILER` is set.
+* `ProfilerCallback` records how long each `fit()`/`predict()` step takes and how long it waited for its batch (input-wait time), and can capture a `tf.profiler` trace of a few steps.
+* The results can be saved as JSON and as TensorBoard scalars.
+
+The example below only runs with `PROFILE_PIPELINE` switched on.
+"""
+
+import collections
+import threading
+
+# Create a class which collects the timings
+class PipelineProfiler:
+  """
+  Collects per-stage preprocessing timings, batch ready times and fit()/predict() step timings.
+  """
+  def __init__(self, max_steps=100000):
+    self.lock = threading.Lock()
+    self.stage_seconds = collections.defaultdict(float)
+    self.stage_counts = collections.defaultdict(int)
+    # Batches which are ready but haven't been picked up by a step yet, per pipeline
+    self.ready_times = collections.defaultdict(lambda: collections.deque(maxlen=max_steps))
+    self.batch_counts = collections.defaultdict(int)
+    self.step_seconds = collections.defaultdict(list)
+    self.input_wait_seconds = collections.defaultdict(list)
+
+  def record_stage(self, stage, seconds):
+    with self.lock:
+      self.stage_seconds[stage] += seconds
+      self.stage_counts[stage] += 1
+    return seconds
+
+  def record_batch_ready(self, pipeline):
+    now = time.time()
+    with self.lock:
+      self.ready_times[pipeline].append(now)
+      self.batch_counts[pipeline] += 1
+    return now
+
+  def record_step(self, mode, pipeline, start, end):
+    """
+    Records a step of mode ("train" or "predict") which ran from start to end, and how long it
+    waited for the next batch of pipeline (batches are used in the order they become ready).
+    """
+    with self.lock:
+      ready_times = self.ready_times[pipeline]
+      ready = ready_times.popleft() if ready_times else start
+      self.step_seconds[mode].append(end - start)
+      self.input_wait_seconds[mode].append(max(0., ready - start))
+
+  def summary(self):
+    """
+    Returns the timings as a dictionary (times in milliseconds).
+    """
+    with self.lock:
+      stages = {stage: {"count": self.stage_counts[stage],
+                        "total_ms": self.stage_seconds[stage] * 1000,
+                        "mean_ms": self.stage_seconds[stage] / self.stage_counts[stage] * 1000}
+                for stage in self.stage_seconds}
+      steps = {}
+      for mode, step_seconds in self.step_seconds.items():
+        step_ms = np.array(step_seconds) * 1000
+        wait_ms = np.array(self.input_wait_seconds[mode]) * 1000
+        steps[mode] = {"count": len(step_ms),
+                       "mean_step_ms": step_ms.mean(),
+                       "p50_step_ms": np.percentile(step_ms, 50),
+                       "p99_step_ms": np.percentile(step_ms, 99),
+                       "mean_input_wait_ms": wait_ms.mean(),
+                       # How much of the step time was spent waiting for data
+                       "input_wait_fraction": wait_ms.sum() / max(step_ms.sum(), 1e-9)}
+      return {"stages": stages, "batches": dict(self.batch_counts), "steps": steps}
+
+  def to_json(self, path):
+    with open(path, "w") as f:
+      json.dump(self.summary(), f, indent=2, default=float)
+    return path
+
+  def write_tensorboard(self, logdir):
+    """
+    Writes the stage means and every step's time and input-wait time as TensorBoard scalars.
+    """
+    summary = self.summary()
+    writer = tf.summary.create_file_writer(logdir)
+    with writer.as_default():
+      for stage, stats in summary["stages"].items():
+        tf.summary.scalar(f"pipeline/{stage}_mean_ms", stats["mean_ms"], step=0)
+      for mode, step_seconds in self.step_seconds.items():
+        for step, (seconds, wait) in enumerate(zip(step_seconds, self.input_wait_seconds[mode])):
+          tf.summary.scalar(f"{mode}/step_ms", seconds * 1000, step=step)
+          tf.summary.scalar(f"{mode}/input_wait_ms", wait * 1000, step=step)
+    writer.flush()
+    return logdir
+
+# Create a callback which times fit() and predict() steps
+class ProfilerCallback(tf.keras.callbacks.Callback):
+  """
+  Records step and input-wait times with a PipelineProfiler. With trace_steps=(first, last) and
+  a trace_dir it also captures a tf.profiler trace of those steps (viewable in TensorBoard).
+  """
+  def __init__(self, profiler, train_pipeline="train", predict_pipeline="test", trace_steps=None, trace_dir=None):
+    super().__init__()
+    self.profiler = profiler
+    self.pipelines = {"train": train_pipeline, "predict": predict_pipeline}
+    self.trace_steps = trace_steps
+    self.trace_dir = trace_dir
+    self.step = 0
+    self.tracing = False
+
+  def step_begin(self):
+    if self.trace_steps and self.step == self.trace_steps[0]:
+      tf.profiler.experimental.start(self.trace_dir)
+      self.tracing = True
+    self.step_start = time.time()
+
+  def step_end(self, mode):
+    self.profiler.record_step(mode, self.pipelines[mode], self.step_start, time.time())
+    if self.tracing and self.step == self.trace_steps[1]:
+      tf.profiler.experimental.stop()
+      self.tracing = False
+    self.step += 1
+
+  def on_train_batch_begin(self, batch, logs=None):
+    self.step_begin()
+
+  def on_train_batch_end(self, batch, logs=None):
+    self.step_end("train")
+
+  def on_predict_batch_begin(self, batch, logs=None):
+    self.step_begin()
+
+  def on_predict_batch_end(self, batch, logs=None):
+    self.step_end("predict")
+
+  def on_train_end(self, logs=None):
+    if self.tracing:
+      tf.profiler.experimental.stop()
+      self.tracing = False
+
+  on_predict_end = on_train_end
+
+# Profile a short training run and a prediction run (only when asked for, it trains for 2 epochs and writes a trace to Drive)
+PROFILE_PIPELINE = False #@param {type:"boolean"}
+
+if PROFILE_PIPELINE:
+  PROFILER = PipelineProfiler()
+  profile_logdir = os.path.join("/content/drive/My Drive/Dog-vision/logs",
+                                "profile-" + datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+  profiled_model = create_model()
+  profiled_model.fit(x=create_data_batches(x_train, y_train),
+                     epochs=2,
+                     validation_data=create_data_batches(x_val, y_val, valid_data=True),
+                     callbacks=[ProfilerCallback(PROFILER, trace_steps=(5, 10), trace_dir=profile_logdir)])
+  profiled_model.predict(create_data_batches(x_val, test_data=True),
+                         callbacks=[ProfilerCallback(PROFILER)])
+
+  # Save the timings and turn profiling off again
+  PROFILER.to_json(profile_logdir + ".json")
+  PROFILER.write_tensorboard(profile_logdir)
+  print(json.dumps(PROFILER.summary(), indent=2, default=float))
+  PROFILER = None
+
 """## Making and evaluating predictions using a trained model"""
 
 # Make redictions on the validation data (not used to train on)
@@ -473,6 +1892,17 @@ def get_pred_label(prediction_probabilities):
   """
   return unique_breeds[np.argmax(prediction_probabilities)]
 
+from metrics import top_k_predictions
+
+# Turn a whole array of prediction probabilities into their top k labels at once
+def decode_predictions(prediction_probabilities, k=5):
+  """
+  Takes an (N, number of breeds) array of prediction probabilities and returns the top k
+  indexes, labels and probabilities of every row (each of shape (N, k)), most likely first.
+  """
+  top_k_indexes, top_k_probabilities = top_k_predictions(prediction_probabilities, k)
+  return top_k_indexes, unique_breeds[top_k_indexes], top_k_probabilities
+
 # Get a predicted label based on an array of prediction probabilities
 pred_label = get_pred_label(predictions[0])
 pred_label
@@ -480,35 +1910,103 @@ pred_label
 """Wonderful! Now we've got a list of all different predictions our model has made, we'll do the same for the validation images and validation labels.
 
 Remember, the model hasn't trained on the validation data, during the fit() function, it only used the validation data to evaluate itself. So we can use the validation images to visually compare our models predictions with the validation labels.
+"""
+
+"""## Evaluating without keeping the whole validation set in memory
 
-Since our validation data (val_data) is in batch form, to get a list of validation images and labels, we'll have to unbatch it (using unbatch()) and then turn it into an iterator using as_numpy_iterator().
+Since our validation data (val_data) is in batch form, we could unbatch it into a list of images and labels, but that keeps every 224x224x3 validation image in memory, which is fine for 200 images but takes gigabytes on the full dataset.
 
-Let's make a small function to do so.
+Instead, we can run the model over the data batch by batch and only keep running totals (how many right, how confident, per breed) plus the few images we actually want to look at: a random sample of the validation images and the mistakes the model was most confident about.
+
+Kaggle scores this competition on multi-class log loss, not accuracy, so the running totals also go into a `StreamingMetrics` (from `metrics.py`), which keeps track of log loss, top-1/top-5 accuracy, the confusion matrix (and from it per breed precision and recall) and calibration (ECE: how far the model's confidence is from its accuracy).
 """
 
-# Create a function to unbatch a batched dataset
-def unbatchify(data):
+import heapq
+
+from metrics import StreamingMetrics
+
+# Create a function which evaluates a model over a batched dataset in one pass
+def evaluate_streaming(model, data, worst_k=25, sample_k=25, seed=42):
   """
-  Takes a batched dataset of (image, label) Tensors and returns separate arrays
-  of images and labels.
+  Runs the model over a batched dataset of (image, label) Tensors once and returns overall and
+  per-breed accuracy and confidence, a StreamingMetrics with log loss, top-k accuracy, the
+  confusion matrix and calibration, plus the worst_k most confident mistakes and a random sample
+  of sample_k images (prediction probabilities, true labels and images) to use with plot_pred()
+  and plot_pred_conf().
   """
-  images = []
-  labels = []
-  # Loop through unbatched data
-  for image, label in data.unbatch().as_numpy_iterator():
-    images.append(image)
-    labels.append(unique_breeds[np.argmax(label)])
-  return images, labels
-
-# Unbatchify the validation data
-val_images, val_labels = unbatchify(val_data)
-val_images[0], val_labels[0]
+  num_breeds = len(unique_breeds)
+  counts = np.zeros(num_breeds, dtype=np.int64)
+  correct_counts = np.zeros(num_breeds, dtype=np.int64)
+  confidence_sums = np.zeros(num_breeds)
+  # Min-heap of (confidence, sample number, prediction probabilities, true label, image), the least confident mistake is on top
+  worst = []
+  # Reservoir of (prediction probabilities, true label, image), every image is equally likely to be in it
+  sample = []
+  rng = np.random.default_rng(seed)
+  sample_number = 0
+  metrics = StreamingMetrics(num_breeds)
+
+  for images, batch_labels in data:
+    batch_predictions = model.predict_on_batch(images)
+    batch_labels = batch_labels.numpy()
+    true_indexes = batch_labels.argmax(axis=1) if batch_labels.ndim == 2 else batch_labels.astype(int)
+    metrics.update(batch_predictions, true_indexes)
+    pred_indexes = batch_predictions.argmax(axis=1)
+    confidences = batch_predictions.max(axis=1)
+    correct = pred_indexes == true_indexes
+
+    # Add the batch to the per breed totals
+    np.add.at(counts, true_indexes, 1)
+    np.add.at(correct_counts, true_indexes, correct)
+    np.add.at(confidence_sums, true_indexes, confidences)
+
+    # Only keep a mistake (and copy its image) if it's worse than the ones we already have
+    for i in np.flatnonzero(~correct):
+      if len(worst) < worst_k or confidences[i] > worst[0][0]:
+        item = (confidences[i], sample_number + i, batch_predictions[i], true_indexes[i], images[i].numpy())
+        if len(worst) < worst_k:
+          heapq.heappush(worst, item)
+        else:
+          heapq.heapreplace(worst, item)
+    # Reservoir sampling: the n-th image replaces a random one with probability sample_k / n
+    for i in range(len(batch_predictions)):
+      j = len(sample) if len(sample) < sample_k else rng.integers(sample_number + i + 1)
+      if j < sample_k:
+        item = (batch_predictions[i], true_indexes[i], images[i].numpy())
+        if j == len(sample):
+          sample.append(item)
+        else:
+          sample[j] = item
+    sample_number += len(batch_predictions)
+
+  per_breed = pd.DataFrame({"breed": unique_breeds,
+                            "count": counts,
+                            "accuracy": correct_counts / np.maximum(counts, 1),
+                            "mean confidence": confidence_sums / np.maximum(counts, 1),
+                            "precision": metrics.per_class()["precision"],
+                            "recall": metrics.per_class()["recall"]})
+  # Most confident mistake first
+  worst = sorted(worst, key=lambda item: item[0], reverse=True)
+  return {"accuracy": correct_counts.sum() / max(counts.sum(), 1),
+          "mean confidence": confidence_sums.sum() / max(counts.sum(), 1),
+          "metrics": metrics,
+          "per breed": per_breed,
+          "worst predictions": np.array([item[2] for item in worst]).reshape(-1, num_breeds),
+          "worst labels": [unique_breeds[item[3]] for item in worst],
+          "worst images": [item[4] for item in worst],
+          "sample predictions": np.array([item[0] for item in sample]).reshape(-1, num_breeds),
+          "sample labels": [unique_breeds[item[1]] for item in sample],
+          "sample images": [item[2] for item in sample]}
+
+# Evaluate the model on the validation data
+evaluation = evaluate_streaming(model, val_data)
+print(f"Accuracy: {evaluation['accuracy']:.3f}, mean confidence: {evaluation['mean confidence']:.3f}")
 
 """Now we've got ways to get:
 
 Prediction labels
 Validation labels (truth labels)
-Validation images
+Validation images (a random sample of them, and the worst mistakes)
 Let's make some functions to make these all a bit more visualize.
 
 More specifically, we want to be able to view an image, its predicted label and its actual label (true label).
@@ -546,9 +2044,9 @@ def plot_pred(prediction_probabilities, labels, images, n=1):
                                       color=color)
 
 # View an example prediction, original image and truth label
-plot_pred(prediction_probabilities=predictions,
-          labels=val_labels,
-          images=val_images)
+plot_pred(prediction_probabilities=evaluation["sample predictions"],
+          labels=evaluation["sample labels"],
+          images=evaluation["sample images"])
 
 """Let's build a function to demonstrate. The function will:
 
@@ -572,12 +2070,9 @@ def plot_pred_conf(prediction_probabilities, labels, n=1):
   # Get the predicted label
   pred_label = get_pred_label(pred_prob)
 
-  # Find the top 10 prediction confidence indexes
-  top_10_pred_indexes = pred_prob.argsort()[-10:][::-1]
-  # Find the top 10 prediction confidence values
-  top_10_pred_values = pred_prob[top_10_pred_indexes]
-  # Find the top 10 prediction labels
-  top_10_pred_labels = unique_breeds[top_10_pred_indexes]
+  # Find the top 10 prediction confidence indexes, labels and values
+  top_10_pred_indexes, top_10_pred_labels, top_10_pred_values = decode_predictions(pred_prob[np.newaxis], k=10)
+  top_10_pred_labels, top_10_pred_values = top_10_pred_labels[0], top_10_pred_values[0]
 
   # Setup plot
   top_plot = plt.bar(np.arange(len(top_10_pred_labels)), 
@@ -593,8 +2088,8 @@ def plot_pred_conf(prediction_probabilities, labels, n=1):
   else:
     pass
 
-plot_pred_conf(prediction_probabilities=predictions,
-               labels=val_labels,
+plot_pred_conf(prediction_probabilities=evaluation["sample predictions"],
+               labels=evaluation["sample labels"],
                n=9)
 
 # Let's check a few predictions and their different values
@@ -605,17 +2100,281 @@ num_images = num_rows*num_cols
 plt.figure(figsize=(5*2*num_cols, 5*num_rows))
 for i in range(num_images):
   plt.subplot(num_rows, 2*num_cols, 2*i+1)
-  plot_pred(prediction_probabilities=predictions,
-            labels=val_labels,
-            images=val_images,
+  plot_pred(prediction_probabilities=evaluation["sample predictions"],
+            labels=evaluation["sample labels"],
+            images=evaluation["sample images"],
             n=i+i_multiplier)
   plt.subplot(num_rows, 2*num_cols, 2*i+2)
-  plot_pred_conf(prediction_probabilities=predictions,
-                labels=val_labels,
+  plot_pred_conf(prediction_probabilities=evaluation["sample predictions"],
+                labels=evaluation["sample labels"],
                 n=i+i_multiplier)
 plt.tight_layout(h_pad=1.0)
 plt.show()
 
+"""Besides the samples we looked at, the running totals tell us how the model does overall and per breed."""
+
+# Log loss (what Kaggle scores), top-1/top-5 accuracy and calibration error
+evaluation["metrics"].result()
+
+# Which breeds does the model struggle with the most?
+evaluation["per breed"].sort_values("accuracy").head(10)
+
+# Which breeds get mixed up the most? (the biggest counts off the diagonal of the confusion matrix)
+confusion_matrix = evaluation["metrics"].confusion_matrix.copy()
+np.fill_diagonal(confusion_matrix, 0)
+mixed_up = np.dstack(np.unravel_index(np.argsort(-confusion_matrix, axis=None)[:10], confusion_matrix.shape))[0]
+pd.DataFrame([{"true breed": unique_breeds[true_index],
+               "predicted breed": unique_breeds[pred_index],
+               "count": confusion_matrix[true_index, pred_index]} for true_index, pred_index in mixed_up])
+
+# Is the model as confident as it is accurate? (a well calibrated model sits on the diagonal)
+reliability = evaluation["metrics"].reliability()
+plt.plot([0, 1], [0, 1], linestyle="--", color="grey")
+plt.plot(reliability["mean confidence"][reliability["count"] > 0],
+         reliability["accuracy"][reliability["count"] > 0], marker="o")
+plt.xlabel("Confidence")
+plt.ylabel("Accuracy")
+
+# The metrics keep up with far more predictions than we have: time 500,000 random ones in batches of 10,000
+random_metrics = StreamingMetrics(len(unique_breeds))
+rng = np.random.default_rng(42)
+random_probabilities = rng.dirichlet(np.ones(len(unique_breeds)), size=10000).astype(np.float32)
+start = time.perf_counter()
+for _ in range(50):
+  random_metrics.update(random_probabilities, rng.integers(0, len(unique_breeds), size=10000))
+print(f"{random_metrics.count / (time.perf_counter() - start):,.0f} predictions/sec")
+
+# Let's look at the mistakes the model was most confident about
+num_rows = 3
+num_cols = 2
+plt.figure(figsize=(5*2*num_cols, 5*num_rows))
+for i in range(min(num_rows*num_cols, len(evaluation["worst labels"]))):
+  plt.subplot(num_rows, 2*num_cols, 2*i+1)
+  plot_pred(prediction_probabilities=evaluation["worst predictions"],
+            labels=evaluation["worst labels"],
+            images=evaluation["worst images"],
+            n=i)
+  plt.subplot(num_rows, 2*num_cols, 2*i+2)
+  plot_pred_conf(prediction_probabilities=evaluation["worst predictions"],
+                 labels=evaluation["worst labels"],
+                 n=i)
+plt.tight_layout(h_pad=1.0)
+plt.show()
+
+"""## Cascading a small model in front of the big one
+
+Most dog photos are easy, and a much smaller model gets them right too. So instead of running every image through the full `mobilenet_v2_130_224` backbone, we can:
+* Run every image through a small model first (MobileNetV2 with a 0.5 width multiplier on 160x160 images, about 10x fewer operations).
+* Only send the images the small model isn't sure about (top probability below a threshold, or too close to the second best) to the full model.
+
+The small model is trained the same way as the full one, `create_model()` resizes its input to 160x160 so both models use the same data batches (and each image is only decoded once).
+"""
+
+# Any TensorFlow Hub classification model works, including a local copy of one (a directory path)
+CHEAP_MODEL_URL = "https://tfhub.dev/google/imagenet/mobilenet_v2_050_160/classification/4"
+CHEAP_MODEL_SIZE = 160
+
+cheap_model = train_model(checkpoint_dir=os.path.join(CHECKPOINT_DIR, "1000-images-cheap"),
+                          model_url=CHEAP_MODEL_URL,
+                          backbone_size=CHEAP_MODEL_SIZE)
+
+# Create a function which only uses the full model when the small model isn't confident
+def cascade_predict_on_batch(cheap_model, full_model, images, threshold=0.8, margin=0.0):
+  """
+  Predicts a batch of images with cheap_model and re-predicts with full_model the images whose
+  top probability is below threshold or less than margin above the second highest one.
+  Returns the prediction probabilities and a boolean array of which images were escalated.
+  """
+  predictions = cheap_model.predict_on_batch(images)
+  top_2 = np.sort(predictions, axis=1)[:, -2:]
+  escalated = (top_2[:, 1] < threshold) | (top_2[:, 1] - top_2[:, 0] < margin)
+  if escalated.any():
+    predictions[escalated] = full_model.predict_on_batch(tf.boolean_mask(images, escalated))
+  return predictions, escalated
+
+# Create a function which compares the cascade with the full model on its own
+def cascade_report(cheap_model, full_model, data, thresholds=(0.5, 0.7, 0.8, 0.9, 0.95), margin=0.0):
+  """
+  Runs the full model, then the cascade at every threshold, over a batched dataset of
+  (image, label) Tensors and returns a DataFrame of escalation rate, accuracy and images/sec.
+  """
+  def run(predict_fn):
+    num_images, num_correct, num_escalated = 0, 0, 0
+    start = time.perf_counter()
+    for images, batch_labels in data:
+      predictions, escalated = predict_fn(images)
+      batch_labels = batch_labels.numpy()
+      true_indexes = batch_labels.argmax(axis=1) if batch_labels.ndim == 2 else batch_labels.astype(int)
+      num_images += len(predictions)
+      num_correct += (predictions.argmax(axis=1) == true_indexes).sum()
+      num_escalated += escalated.sum()
+    seconds = time.perf_counter() - start
+    return {"escalation rate": num_escalated / num_images,
+            "accuracy": num_correct / num_images,
+            "images/sec": num_images / seconds}
+
+  # Warm up both models, so the first timed run doesn't include building the predict functions
+  images, _ = next(iter(data))
+  cascade_predict_on_batch(cheap_model, full_model, images, threshold=1.1)
+
+  rows = [{"threshold": None,
+           **run(lambda images: (full_model.predict_on_batch(images), np.ones(len(images), dtype=bool)))}]
+  for threshold in thresholds:
+    rows.append({"threshold": threshold,
+                 **run(lambda images: cascade_predict_on_batch(cheap_model, full_model, images,
+                                                               threshold=threshold, margin=margin))})
+  report = pd.DataFrame(rows)
+  # Compared with the full model on its own (the first row)
+  report["speedup"] = report["images/sec"] / report["images/sec"][0]
+  report["accuracy loss"] = report["accuracy"][0] - report["accuracy"]
+  return report
+
+# How many images does the cascade send to the full model, and what does it cost in accuracy?
+cascade_report(cheap_model, model, val_data)
+
+"""## Caching predictions
+
+We predict the same custom and test images again and again, and every time they all go through `create_data_batches()` and the model. But if neither the image nor the model changed, the prediction won't either.
+
+So let's keep every prediction, keyed by:
+* The SHA-1 of the image file (a renamed copy of an image is still a hit, an edited image isn't). It comes from the manifest, so the files aren't read again just to hash them.
+* A fingerprint of the model and its preprocessing: the SHA-1 of its weights, `IMG_SIZE`, `FAST_DECODE` and `PREPROCESSING_VERSION` (retraining the model or changing how images are preprocessed changes it). `READ_AHEAD` only changes how the files are read, not the pixels, so it isn't part of it.
+
+The most recent predictions are kept in memory, and all of them on disk (so they survive restarting the notebook). Only the images which miss both are predicted. Since the key includes the model, saving a new model doesn't have to throw anything away, `invalidate()` frees the disk space by hand.
+"""
+
+import collections
+
+PREDICTION_CACHE_DIR = "/content/dog-vision-predictions" #@param {type:"string"}
+# Bump this whenever process_image(), decode_image() or their fast versions change what they return
+PREPROCESSING_VERSION = 1
+
+# Create a function which fingerprints a model by its weights and the preprocessing of its inputs
+def model_fingerprint(model, fast_decode=FAST_DECODE):
+  """
+  Returns the SHA-1 hex digest of a model's weights, its input size, the decode setting and
+  PREPROCESSING_VERSION.
+  """
+  fingerprint = hashlib.sha1(json.dumps({"img_size": IMG_SIZE,
+                                         "fast_decode": bool(fast_decode),
+                                         "preprocessing_version": PREPROCESSING_VERSION}).encode())
+  for weights in model.get_weights():
+    fingerprint.update(str(weights.shape).encode())
+    fingerprint.update(np.ascontiguousarray(weights).tobytes())
+  return fingerprint.hexdigest()
+
+class PredictionCache:
+  """
+  Prediction probabilities keyed by (model fingerprint, image SHA-1), with the max_memory_items
+  most recently used in memory and all of them in cache_dir.
+  """
+  def __init__(self, cache_dir=PREDICTION_CACHE_DIR, max_memory_items=10000):
+    self.cache_dir = cache_dir
+    self.max_memory_items = max_memory_items
+    self.memory = collections.OrderedDict()
+    self.counts = collections.Counter()
+
+  def cache_path(self, fingerprint, image_hash):
+    return os.path.join(self.cache_dir, fingerprint, image_hash[:2], image_hash + ".npy")
+
+  def remember(self, key, prediction):
+    self.memory[key] = prediction
+    self.memory.move_to_end(key)
+    # Forget the least recently used prediction
+    if len(self.memory) > self.max_memory_items:
+      self.memory.popitem(last=False)
+
+  def get(self, fingerprint, image_hash):
+    """
+    Returns the cached prediction, or None.
+    """
+    key = (fingerprint, image_hash)
+    if key in self.memory:
+      self.counts["memory hits"] += 1
+      self.memory.move_to_end(key)
+      return self.memory[key]
+    cache_path = self.cache_path(fingerprint, image_hash)
+    if tf.io.gfile.exists(cache_path):
+      self.counts["disk hits"] += 1
+      with tf.io.gfile.GFile(cache_path, "rb") as f:
+        prediction = np.load(f)
+      self.remember(key, prediction)
+      return prediction
+    self.counts["misses"] += 1
+    return None
+
+  def put(self, fingerprint, image_hash, prediction):
+    self.remember((fingerprint, image_hash), prediction)
+    cache_path = self.cache_path(fingerprint, image_hash)
+    tf.io.gfile.makedirs(os.path.dirname(cache_path))
+    # Write to a temporary file first so an interrupted run never leaves a half written prediction behind
+    with tf.io.gfile.GFile(cache_path + ".tmp", "wb") as f:
+      np.save(f, prediction)
+    tf.io.gfile.rename(cache_path + ".tmp", cache_path, overwrite=True)
+
+  def predict(self, model, image_paths, batch_size=BATCH_SIZE, fast_decode=FAST_DECODE, read_ahead=READ_AHEAD,
+              fingerprint=None):
+    """
+    Returns the prediction probabilities of model for image_paths (in the same order),
+    only running the model on images it hasn't predicted before with the same preprocessing.
+    Pass the model_fingerprint() when calling this many times with the same model.
+    """
+    if fingerprint is None:
+      fingerprint = model_fingerprint(model, fast_decode=fast_decode)
+    # From the manifests (or hashed once and remembered), so hits don't read the files
+    image_hashes = content_hashes(image_paths, cache_dir=self.cache_dir)
+    predictions = {}
+    missing = {}
+    for path, image_hash in zip(image_paths, image_hashes):
+      if image_hash in predictions or image_hash in missing:
+        continue
+      prediction = self.get(fingerprint, image_hash)
+      if prediction is None:
+        missing[image_hash] = path
+      else:
+        predictions[image_hash] = prediction
+
+    if missing:
+      print(f"Predicting {len(missing)} of {len(image_paths)} images (the rest are cached)...")
+      missing_hashes = list(missing)
+      start = 0
+      for batch in create_data_batches(list(missing.values()), batch_size=batch_size, test_data=True,
+                                       fast_decode=fast_decode, read_ahead=read_ahead):
+        for image_hash, prediction in zip(missing_hashes[start:], model.predict_on_batch(batch)):
+          predictions[image_hash] = prediction
+          self.put(fingerprint, image_hash, prediction)
+        start += len(batch)
+    return np.array([predictions[image_hash] for image_hash in image_hashes]).reshape(-1, OUTPUT_SHAPE)
+
+  def invalidate(self, keep_model=None):
+    """
+    Forgets every cached prediction, except the ones made by keep_model (with the current
+    preprocessing settings), to free up disk space.
+    """
+    keep = model_fingerprint(keep_model) if keep_model is not None else None
+    self.memory = collections.OrderedDict((key, value) for key, value in self.memory.items()
+                                          if key[0] == keep)
+    if tf.io.gfile.isdir(self.cache_dir):
+      for fingerprint in tf.io.gfile.listdir(self.cache_dir):
+        fingerprint = fingerprint.rstrip("/")
+        # index.json holds the content hashes, not predictions
+        if fingerprint != keep and tf.io.gfile.isdir(os.path.join(self.cache_dir, fingerprint)):
+          tf.io.gfile.rmtree(os.path.join(self.cache_dir, fingerprint))
+
+  def stats(self):
+    """
+    Returns the number of memory hits, disk hits and misses so far.
+    """
+    return {name: self.counts[name] for name in ["memory hits", "disk hits", "misses"]}
+
+# The cache used for predictions from here on
+prediction_cache = PredictionCache(PREDICTION_CACHE_DIR)
+
+# Predict the validation images twice: the second time everything comes from the cache
+cached_predictions = prediction_cache.predict(model, x_val)
+cached_predictions = prediction_cache.predict(model, x_val)
+prediction_cache.stats()
+
 """## Saving and reloading a model
 After training a model, it's a good idea to save it. Saving it means you can share it with colleagues, put it in an application and more importantly, won't have to go through the potentially expensive step of retraining it.
 
@@ -624,10 +2383,39 @@ The format of an entire saved Keras model is h5. So we'll make a function which
 
 """
 
-def save_model(model, suffix=None):
+# Create a function which gives the path of the settings file saved with a model
+def model_settings_path(model_path):
+  """
+  Returns where the settings of a model are saved: settings.json inside a SavedModel directory,
+  or next to a .h5 file.
+  """
+  if tf.io.gfile.isdir(model_path):
+    return os.path.join(model_path, "settings.json")
+  return os.path.splitext(model_path)[0] + "-settings.json"
+
+def save_model_settings(model_path, settings=None):
+  """
+  Saves the image size and batch sizes to use with a model next to it.
+  """
+  model_settings = {"img_size": IMG_SIZE, "batch_size": BATCH_SIZE, "predict_batch_size": BATCH_SIZE}
+  model_settings.update({name: value for name, value in (settings or {}).items() if name in model_settings})
+  with tf.io.gfile.GFile(model_settings_path(model_path), "w") as f:
+    json.dump(model_settings, f)
+
+def load_model_settings(model_path):
+  """
+  Loads the settings saved with a model (the defaults if it doesn't have any).
+  """
+  model_settings = {"img_size": IMG_SIZE, "batch_size": BATCH_SIZE, "predict_batch_size": BATCH_SIZE}
+  if tf.io.gfile.exists(model_settings_path(model_path)):
+    with tf.io.gfile.GFile(model_settings_path(model_path)) as f:
+      model_settings.update(json.load(f))
+  return model_settings
+
+def save_model(model, suffix=None, settings=None):
   """
   Saves a given model in a models directory and appends a suffix (str)
-  for clarity and reuse.
+  for clarity and reuse. settings (e.g. from autotune_batch_size()) are saved next to it.
   """
   # Create model directory with current time
   modeldir = os.path.join("drive/My Drive/Data/models",
@@ -635,6 +2423,7 @@ def save_model(model, suffix=None):
   model_path = modeldir + "-" + suffix + ".h5" # save format of model
   print(f"Saving model to: {model_path}...")
   model.save(model_path)
+  save_model_settings(model_path, settings)
   return model_path
 
 def load_model(model_path):
@@ -647,7 +2436,7 @@ def load_model(model_path):
   return model
 
 # Save our model trained on 1000 images
-save_model(model, suffix="1000-images-Adam")
+save_model(model, suffix="1000-images-Adam", settings=tuned_settings)
 
 # Load our model trained on 1000 images
 model_1000_images = load_model('/content/drive/My Drive/Data/models/20201012-15531602518032-1000-images-Adam.h5')
@@ -660,13 +2449,131 @@ model.evaluate(val_data)
 # Evaluate the loaded model
 model_1000_images.evaluate(val_data)
 
+"""## Exporting a quantized model for CPUs
+
+We serve on machines without a GPU, where a float32 `.h5` model with a `hub.KerasLayer` inside isn't the fastest option. TensorFlow Lite can shrink the model and speed it up on CPUs with post-training quantization:
+* **dynamic**: weights are stored as int8, activations stay float (no calibration needed).
+* **int8**: weights and activations are int8. The range of the activations is calibrated on a few batches of real images from `create_data_batches()`.
+
+Then we compare size, latency, accuracy and log loss against the float Keras model on the validation set.
+"""
+
+# Create a function which converts a Keras model to TensorFlow Lite
+def export_tflite(model, output_path, quantization="dynamic", representative_data=None, num_calibration_batches=10):
+  """
+  Converts a model to a TensorFlow Lite file with quantization "none", "dynamic" or "int8".
+  int8 needs representative_data, a batched dataset of images (e.g. from create_data_batches(..., test_data=True)).
+  """
+  converter = tf.lite.TFLiteConverter.from_keras_model(model)
+  if quantization in ("dynamic", "int8"):
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  if quantization == "int8":
+    # The converter wants one image at a time to calibrate the activation ranges
+    def representative_dataset():
+      for images in representative_data.take(num_calibration_batches):
+        for image in images:
+          yield [image[tf.newaxis]]
+    converter.representative_dataset = representative_dataset
+    # Every op in int8, the model still takes and returns floats so it's a drop-in replacement
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+  tflite_model = converter.convert()
+  os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+  with open(output_path, "wb") as f:
+    f.write(tflite_model)
+  print(f"Saved {quantization} TensorFlow Lite model to: {output_path} ({len(tflite_model) / 1e6:.1f} MB)")
+  return output_path
+
+# Create a function which runs a TensorFlow Lite model on a batch of images
+def tflite_predict(interpreter, images):
+  """
+  Returns the prediction probabilities of a TensorFlow Lite interpreter for a batch of images.
+  """
+  input_details = interpreter.get_input_details()[0]
+  output_details = interpreter.get_output_details()[0]
+  # Only reallocate when the batch size changes
+  if input_details["shape"][0] != len(images):
+    interpreter.resize_tensor_input(input_details["index"], [len(images), *input_details["shape"][1:]])
+    interpreter.allocate_tensors()
+  interpreter.set_tensor(input_details["index"], np.asarray(images, dtype=np.float32))
+  interpreter.invoke()
+  return interpreter.get_tensor(output_details["index"])
+
+# Create a function which times a predict function on a batch of images
+def median_latency(predict_fn, images, num_runs=20):
+  """
+  Returns the median time (in milliseconds) predict_fn takes on images, after one warm up run.
+  """
+  predict_fn(images)
+  timings = []
+  for _ in range(num_runs):
+    start = time.perf_counter()
+    predict_fn(images)
+    timings.append(time.perf_counter() - start)
+  return np.median(timings) * 1000
+
+# Create a function which compares TensorFlow Lite models to the Keras model they were made from
+def compare_tflite_models(model, tflite_paths, data, keras_model_path=None, batch_size=BATCH_SIZE):
+  """
+  Reports model size, single image and batched latency, accuracy and log loss of the Keras
+  model and every TensorFlow Lite model in tflite_paths ({name: path}) on a batched (image, label) dataset.
+  """
+  images, labels = [], []
+  for batch_images, batch_labels in data:
+    images.append(batch_images.numpy())
+    labels.append(batch_labels.numpy())
+  images = np.concatenate(images)
+  labels = np.concatenate(labels)
+  true_indexes = labels.argmax(axis=1) if labels.ndim == 2 else labels.astype(int)
+
+  predict_fns = {"keras float32": model.predict_on_batch}
+  sizes = {"keras float32": os.path.getsize(keras_model_path) / 1e6 if keras_model_path else np.nan}
+  for name, tflite_path in tflite_paths.items():
+    interpreter = tf.lite.Interpreter(model_path=tflite_path)
+    interpreter.allocate_tensors()
+    predict_fns[name] = functools.partial(tflite_predict, interpreter)
+    sizes[name] = os.path.getsize(tflite_path) / 1e6
+
+  rows = []
+  for name, predict_fn in predict_fns.items():
+    probabilities = np.concatenate([np.asarray(predict_fn(images[i:i + batch_size]))
+                                    for i in range(0, len(images), batch_size)])
+    true_probabilities = probabilities[np.arange(len(true_indexes)), true_indexes]
+    rows.append({"model": name,
+                 "size (MB)": sizes[name],
+                 "1 image latency (ms)": median_latency(predict_fn, images[:1]),
+                 f"{batch_size} image latency (ms)": median_latency(predict_fn, images[:batch_size]),
+                 "accuracy": np.mean(probabilities.argmax(axis=1) == true_indexes),
+                 "log loss": -np.mean(np.log(np.clip(true_probabilities, 1e-15, 1)))})
+  report = pd.DataFrame(rows).set_index("model")
+  # How much worse (or better) than the float model
+  report["accuracy delta"] = report["accuracy"] - report.loc["keras float32", "accuracy"]
+  report["log loss delta"] = report["log loss"] - report.loc["keras float32", "log loss"]
+  return report
+
+# Export the model trained on 1000 images with each kind of quantization
+tflite_dir = "drive/My Drive/Data/models/tflite"
+calibration_data = create_data_batches(x_train, test_data=True)
+tflite_paths = {f"tflite {quantization}": export_tflite(model,
+                                                        os.path.join(tflite_dir, f"1000-images-{quantization}.tflite"),
+                                                        quantization=quantization,
+                                                        representative_data=calibration_data)
+                for quantization in ["none", "dynamic", "int8"]}
+
+# Compare them to the float Keras model on the validation set
+compare_tflite_models(model, tflite_paths, val_data,
+                      keras_model_path='/content/drive/My Drive/Data/models/20201012-15531602518032-1000-images-Adam.h5')
+
 """## Training a model (on the full data)"""
 
 # Remind ourselves of the size of the full dataset
 len(x), len(y)
 
 # Turn full training data in a data batch
-full_data = create_data_batches(x, y)
+full_data = create_data_batches(x, y, cache_dir=PREPROCESSED_CACHE_DIR)
+
+# Train only the Dense head on cached embeddings instead of running MobileNetV2 on every epoch
+TRAIN_HEAD_ONLY = True #@param {type:"boolean"}
 
 # Instantiate a new model for training on the full dataset
 full_model = create_model()
@@ -685,66 +2592,499 @@ full_model_early_stopping = tf.keras.callbacks.EarlyStopping(monitor="accuracy",
 # %tensorboard --logdir drive/My\ Drive/Dog-vision/logs
 
 # Fit the full model to the full training data
-full_model.fit(x=full_data,
-               epochs=NUM_EPOCHS,
-               callbacks=[full_model_tensorboard, 
-                          full_model_early_stopping])
+if TRAIN_HEAD_ONLY:
+  full_model = train_head_on_embeddings(cache_embeddings(x), y)
+else:
+  # Resume from the latest checkpoint if the runtime was disconnected
+  full_model_checkpoint = ResumableCheckpoint(os.path.join(CHECKPOINT_DIR, "all-images",
+                                                           checkpoint_key(x, y, model_url=MODEL_URL)),
+                                              full_model_early_stopping)
+  full_model.fit(x=full_data,
+                 epochs=NUM_EPOCHS,
+                 initial_epoch=full_model_checkpoint.restore(full_model, epochs=NUM_EPOCHS),
+                 callbacks=[full_model_tensorboard, 
+                            full_model_early_stopping,
+                            full_model_checkpoint])
 
 """## Saving and reloading the full model"""
 
 # Save model to file
-save_model(full_model, suffix="all-images-Adam")
+save_model(full_model, suffix="all-images-Adam", settings=tuned_settings)
 
 # Load in the full model
 loaded_full_model = load_model('/content/drive/My Drive/Data/models/20201012-15531602518032-1000-images-Adam.h5')
 
+# And the batch sizes picked for it
+loaded_full_model_settings = load_model_settings('/content/drive/My Drive/Data/models/20201012-15531602518032-1000-images-Adam.h5')
+
+"""### Compiled prediction functions for a few images
+
+`model.predict()` is made for big datasets: every call wraps the images in a dataset, runs the Keras predict loop and puts the outputs back together. For one or a few images (like our custom images, or a request to `serve.py`) that takes longer than running MobileNetV2 itself. And a `tf.function` called with a batch size it hasn't seen before has to be traced again.
+
+So `CompiledPredictor` traces the model once for each batch size in a fixed set of buckets (1, 2, 4, ..., 64) when it's created, optionally compiled with XLA (`jit_compile=True`). Images are padded up to the nearest bucket, so a call never traces, and the predictions for the padding are cut off.
+"""
+
+# Batch sizes to trace the model for (more images than the biggest are split into batches of it)
+PREDICT_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+class CompiledPredictor:
+  """
+  Predicts with a model through tf.functions traced for fixed batch sizes (buckets), padding the
+  images to the nearest bucket. With jit_compile=True the functions are compiled with XLA.
+  """
+  def __init__(self, model, buckets=PREDICT_BUCKETS, jit_compile=False):
+    self.model = model
+    self.buckets = sorted(buckets)
+    predict_fn = tf.function(lambda images: model(images, training=False), jit_compile=jit_compile)
+    self.functions = {bucket: predict_fn.get_concrete_function(tf.TensorSpec([bucket] + INPUT_SHAPE[1:], tf.float32))
+                      for bucket in self.buckets}
+    # Run every bucket once, so nothing is compiled on the first real call
+    for bucket, function in self.functions.items():
+      function(tf.zeros([bucket] + INPUT_SHAPE[1:]))
+
+  def predict_on_batch(self, images):
+    """
+    Returns the prediction probabilities for a batch of preprocessed images, like model.predict_on_batch().
+    """
+    images = tf.convert_to_tensor(images, dtype=tf.float32)
+    predictions = [np.zeros([0, OUTPUT_SHAPE], dtype=np.float32)]
+    for start in range(0, images.shape[0], self.buckets[-1]):
+      batch = images[start:start + self.buckets[-1]]
+      size = batch.shape[0]
+      bucket = next(bucket for bucket in self.buckets if bucket >= size)
+      batch = tf.pad(batch, [[0, bucket - size], [0, 0], [0, 0], [0, 0]])
+      predictions.append(self.functions[bucket](batch)[:size].numpy())
+    return np.concatenate(predictions)
+
+  def predict(self, data):
+    """
+    Returns the prediction probabilities for preprocessed images or a dataset of batches of them.
+    """
+    if isinstance(data, tf.data.Dataset):
+      return np.concatenate([self.predict_on_batch(batch[0] if isinstance(batch, tuple) else batch)
+                             for batch in data])
+    return self.predict_on_batch(data)
+
+  def get_weights(self):
+    # The model's weights, so PredictionCache gives the predictor and the model the same fingerprint
+    return self.model.get_weights()
+
+# Create a function which compares the latency of CompiledPredictor with model.predict()
+def predictor_latency_report(model, batch_sizes=(1, 2, 3, 8, 20, 32, 64), num_runs=20):
+  """
+  Returns a DataFrame of the median latency of model.predict(), model.predict_on_batch() and
+  CompiledPredictor (with and without XLA) for every batch size.
+  """
+  predict_fns = {"model.predict()": lambda images: model.predict(images, verbose=0),
+                 "model.predict_on_batch()": model.predict_on_batch,
+                 "CompiledPredictor": CompiledPredictor(model).predict_on_batch,
+                 "CompiledPredictor (XLA)": CompiledPredictor(model, jit_compile=True).predict_on_batch}
+  rows = []
+  for batch_size in batch_sizes:
+    images = np.random.rand(batch_size, IMG_SIZE, IMG_SIZE, 3).astype(np.float32)
+    row = {"batch size": batch_size}
+    for name, predict_fn in predict_fns.items():
+      row[f"{name} (ms)"] = median_latency(predict_fn, images, num_runs=num_runs)
+    rows.append(row)
+  return pd.DataFrame(rows)
+
+# How long does each way of predicting take for 1 to 64 images?
+predictor_latency_report(loaded_full_model)
+
+# The predictor we'll use for custom images
+loaded_full_predictor = CompiledPredictor(loaded_full_model)
+
+"""### Exporting the full model for predict.py
+
+An `.h5` file needs TensorFlow Hub and `custom_objects={"KerasLayer":hub.KerasLayer}` to load, and to make predictions we also need `unique_breeds` (which means reading `labels.csv` again). For `predict.py` we export a SavedModel instead, which:
+* loads with plain `tf.saved_model.load()`,
+* has a `predict_jpeg` signature which takes the raw bytes of JPEG files, so the preprocessing is the exact same as `process_image()`,
+* has the breed names saved next to it in `breeds.txt`.
+"""
+
+# Name of the file next to an exported model which holds the breed names (one per line, in output order)
+BREEDS_FILENAME = "breeds.txt"
+
+def export_saved_model(model, export_dir, settings=None):
+  """
+  Exports a model as a SavedModel (with the breed names and settings saved next to it) for predict.py.
+  """
+  # Takes preprocessed images, like model.predict()
+  @tf.function(input_signature=[tf.TensorSpec(INPUT_SHAPE, tf.float32, name="images")])
+  def serve_images(images):
+    return {"probabilities": model(images, training=False)}
+
+  # Takes the bytes of JPEG files and preprocesses them like process_image()
+  @tf.function(input_signature=[tf.TensorSpec([None], tf.string, name="images")])
+  def serve_jpeg(images):
+    images = tf.map_fn(decode_image, images, fn_output_signature=tf.TensorSpec(INPUT_SHAPE[1:], tf.float32))
+    return {"probabilities": model(images, training=False)}
+
+  print(f"Exporting SavedModel to: {export_dir}...")
+  # The profiling records (tf.py_function) can't go into a SavedModel, so trace with profiling off
+  global PROFILER
+  profiler, PROFILER = PROFILER, None
+  try:
+    tf.saved_model.save(model, export_dir, signatures={"serving_default": serve_images,
+                                                       "predict_jpeg": serve_jpeg})
+  finally:
+    PROFILER = profiler
+  with open(os.path.join(export_dir, BREEDS_FILENAME), "w") as f:
+    f.write("\n".join(unique_breeds))
+  save_model_settings(export_dir, settings)
+  return export_dir
+
+# Export the full model for predict.py
+export_saved_model(full_model, "drive/My Drive/Data/models/all-images-Adam-savedmodel", settings=tuned_settings)
+
+"""## Distilling the full model into a smaller one
+
+Most of the time (and cost) of a prediction is the `mobilenet_v2_130_224` backbone. The small MobileNetV2 (0.5 width multiplier, 160x160 images) from the cascade is about 10x cheaper, but trained on the labels alone it's noticeably less accurate.
+
+Instead, we can train the small model (the student) to copy the full model (the teacher):
+* Run the teacher over the training images once and save its prediction probabilities (a `.npy` file, so the next runs skip this).
+* Train the student on those probabilities instead of the labels. They say more than the label does: which other breeds an image looks like, and how much.
+* Optionally mix in the true labels (`alpha`), and soften the teacher's probabilities (`temperature` > 1) so the smaller ones count for more.
+
+With a temperature the student's probabilities are softened the same way inside the loss (dividing its logits by `temperature`), so both are compared at the same temperature, and that part of the loss is multiplied by `temperature ** 2` so its gradients keep their size. The true labels are compared with the student's normal (temperature 1) probabilities, which are also what it predicts with afterwards.
+
+The student is trained with `create_data_batches()` like every other model, only with the teacher's (softened) probabilities and the true labels side by side as the labels. Once it's trained it gets the normal loss back, so it's saved and loaded like any other model.
+"""
+
+TEACHER_PREDICTIONS_DIR = "/content/dog-vision-teacher-predictions" #@param {type:"string"}
+STUDENT_MODEL_URL = CHEAP_MODEL_URL
+STUDENT_MODEL_SIZE = CHEAP_MODEL_SIZE
+
+# Create a function which turns labels (indexes or one-hot) into one-hot float rows
+def to_one_hot(labels):
+  """
+  Returns labels as a float32 array of one-hot rows.
+  """
+  labels = np.asarray(labels)
+  if labels.ndim == 2:
+    return labels.astype(np.float32)
+  return np.eye(len(unique_breeds), dtype=np.float32)[labels]
+
+# Create a function which predicts the training images with the teacher once
+def cache_teacher_predictions(teacher, X, cache_dir=TEACHER_PREDICTIONS_DIR):
+  """
+  Returns the teacher's prediction probabilities for every image in X as a read-only
+  memory-mapped array, computing and saving them first if they aren't cached yet.
+  """
+  # The file name depends on the teacher's weights and the images' contents, so a retrained teacher never reuses it
+  key = hashlib.sha1("\n".join([model_fingerprint(teacher), str(IMG_SIZE)]
+                               + content_hashes(X, cache_dir=cache_dir)).encode()).hexdigest()
+  predictions_path = os.path.join(cache_dir, key + ".npy")
+  if not os.path.exists(predictions_path):
+    print(f"Predicting {len(X)} images with the teacher...")
+    predict_to_npy(teacher, X, predictions_path)
+  print(f"Loading teacher predictions from: {predictions_path}")
+  return np.load(predictions_path, mmap_mode="r")
+
+# Create a function which softens probabilities as if their logits were divided by temperature
+def soften(probabilities, temperature):
+  """
+  Returns probabilities ** (1 / temperature), normalized (the softmax of log(probabilities) / temperature).
+  """
+  probabilities = np.asarray(probabilities, dtype=np.float64) ** (1 / temperature)
+  return probabilities / probabilities.sum(axis=1, keepdims=True)
+
+# Create a function which builds the loss a student is trained with
+def create_distillation_loss(alpha=0.0, temperature=1.0):
+  """
+  Returns a loss for labels made of the teacher's softened probabilities followed by the one-hot
+  true labels: temperature ** 2 times the cross-entropy between the teacher and the student softened
+  by temperature, mixed with the cross-entropy between the true labels and the student by alpha.
+  """
+  num_classes = len(unique_breeds)
+  def distillation_loss(y_true, y_pred):
+    teacher_targets, true_labels = y_true[:, :num_classes], y_true[:, num_classes:]
+    # log(p) is the logits up to a constant, which the softmax ignores
+    student_logits = tf.math.log(tf.clip_by_value(y_pred, 1e-7, 1.0))
+    soft_predictions = tf.nn.softmax(student_logits / temperature)
+    soft_loss = tf.keras.losses.categorical_crossentropy(teacher_targets, soft_predictions)
+    hard_loss = tf.keras.losses.categorical_crossentropy(true_labels, y_pred)
+    return (1 - alpha) * temperature ** 2 * soft_loss + alpha * hard_loss
+  return distillation_loss
+
+# Create a function which measures accuracy on the true labels half of the distillation labels
+def distillation_accuracy(y_true, y_pred):
+  """
+  Returns the top-1 accuracy of y_pred on the one-hot true labels in the second half of y_true.
+  """
+  return tf.keras.metrics.categorical_accuracy(y_true[:, len(unique_breeds):], y_pred)
+
+# Create a function which trains a small model to copy a bigger one
+def train_student(teacher, X_train, y_train, X_val=None, y_val=None, alpha=0.0, temperature=1.0,
+                  model_url=STUDENT_MODEL_URL, backbone_size=STUDENT_MODEL_SIZE, checkpoint_dir=None):
+  """
+  Trains a model built by create_model() from model_url on the teacher's prediction probabilities
+  for X_train, mixed with the one-hot y_train labels by alpha (0 = only the teacher).
+  temperature > 1 softens both the teacher's and the student's probabilities in the loss.
+  Validation accuracy uses the true y_val labels. The returned student has the normal loss again.
+  """
+  teacher_predictions = cache_teacher_predictions(teacher, X_train)
+  # The teacher's softened probabilities and the true labels side by side, split up again by the loss
+  targets = np.concatenate([soften(teacher_predictions, temperature), to_one_hot(y_train)],
+                           axis=1).astype(np.float32)
+
+  student = create_model(model_url=model_url, sparse_labels=False, backbone_size=backbone_size)
+  student.compile(loss=create_distillation_loss(alpha, temperature),
+                  optimizer=tf.keras.optimizers.Adam(),
+                  metrics=[tf.keras.metrics.MeanMetricWrapper(distillation_accuracy, name="accuracy")])
+  student_train_data = create_data_batches(X_train, targets, cache_dir=PREPROCESSED_CACHE_DIR)
+  if X_val is not None:
+    # The soft half doesn't count towards accuracy, so the true labels go in both halves
+    val_labels = np.concatenate([to_one_hot(y_val), to_one_hot(y_val)], axis=1)
+    student_val_data = create_data_batches(X_val, val_labels, valid_data=True, cache_dir=PREPROCESSED_CACHE_DIR)
+    student_early_stopping = tf.keras.callbacks.EarlyStopping(monitor="val_accuracy", patience=3)
+  else:
+    student_val_data = None
+    student_early_stopping = tf.keras.callbacks.EarlyStopping(monitor="accuracy", patience=3)
+  callbacks = [create_tensorboard_callback(), student_early_stopping]
+
+  initial_epoch = 0
+  if checkpoint_dir:
+    # A different teacher, data set or distillation setting starts a fresh run
+    checkpoint_dir = os.path.join(checkpoint_dir, checkpoint_key(
+        X_train, y_train,
+        x_val=checkpoint_key(X_val, y_val) if X_val is not None else None,
+        teacher=model_fingerprint(teacher), model_url=model_url, backbone_size=backbone_size,
+        alpha=alpha, temperature=temperature))
+    checkpoint = ResumableCheckpoint(checkpoint_dir, student_early_stopping)
+    initial_epoch = checkpoint.restore(student, epochs=NUM_EPOCHS)
+    callbacks.append(checkpoint)
+
+  student.fit(x = student_train_data,
+              epochs = NUM_EPOCHS,
+              initial_epoch = initial_epoch,
+              validation_data = student_val_data,
+              callbacks = callbacks)
+
+  # Predictions are the student's normal probabilities, so it's saved with the normal loss
+  student.compile(loss=create_loss(sparse_labels=False),
+                  optimizer=tf.keras.optimizers.Adam(),
+                  metrics=["accuracy"])
+  return student
+
+# Create a function which compares the student with its teacher
+def distillation_report(teacher, student, data):
+  """
+  Runs both models over a batched dataset of (image, label) Tensors and returns a DataFrame of
+  log loss, top-1/top-5 accuracy, images/sec and single image latency, plus the student's
+  speedup and accuracy gap.
+  """
+  one_image = next(iter(data))[0][:1]
+  rows = []
+  for name, model in [("teacher", teacher), ("student", student)]:
+    model.predict_on_batch(one_image)
+    metrics = StreamingMetrics(len(unique_breeds))
+    start = time.perf_counter()
+    for images, batch_labels in data:
+      metrics.update(model.predict_on_batch(images), batch_labels.numpy())
+    seconds = time.perf_counter() - start
+    rows.append({"model": name,
+                 **metrics.result(),
+                 "images/sec": metrics.count / seconds,
+                 "single image (ms)": median_latency(model.predict_on_batch, one_image)})
+  report = pd.DataFrame(rows)
+  report["speedup"] = report["images/sec"] / report["images/sec"][0]
+  report["accuracy gap"] = report["top-1 accuracy"][0] - report["top-1 accuracy"]
+  return report
+
+# The loaded full model teaches a small model on the training images
+student_model = train_student(loaded_full_model, x_train, y_train, x_val, y_val,
+                              checkpoint_dir=os.path.join(CHECKPOINT_DIR, "student"))
+
+# How much faster is the student, and how much accuracy does it give up?
+distillation_report(loaded_full_model, student_model, val_data)
+
+# Save the student (and export it for predict.py) like any other model
+save_model(student_model, suffix="student-mobilenetV2-050-160", settings=tuned_settings)
+export_saved_model(student_model, "drive/My Drive/Data/models/student-savedmodel", settings=tuned_settings)
+
 """##Making predictions on the test dataset"""
 
-# Load test image filenames (since we're using os.listdir(), these already have .jpg)
+# Load test image filenames from the test manifest (indexed the first time, every test image is kept)
 test_path = "drive/My Drive/Data/test/"
-test_filenames = [test_path + fname for fname in os.listdir(test_path)]
+test_manifest = load_manifest(TEST_MANIFEST_PATH, image_dir=test_path)
+test_filenames = list(test_manifest["path"])
 
 test_filenames[:10]
 
 # How many test images are there?
 len(test_filenames)
 
-# Create test data batch
-test_data = create_data_batches(test_filenames, test_data=True)
-
-# Make predictions on test data batch using the loaded full model
-test_predictions = loaded_full_model.predict(test_data,
-                                             verbose=1)
-
-# Check out the test predictions
-test_predictions[:10]
-
 """##Preparing test dataset predictions for Kaggle
 Looking at the Kaggle sample submission, it looks like they want the models output probabilities each for label along with the image ID's.
 
-To get the data in this format, we'll:
+Instead of keeping the predictions for the whole test set in memory and building one big DataFrame at the end, we'll write the predictions while `predict` runs:
+
+* Turn the test filepaths into data batches (in the same order as the filepaths).
+* For each batch, get the prediction probabilities and the image ID's of the same filepaths.
+* Append a chunk with an ID column and a column for each dog breed to the submission file (CSV, or Parquet part files).
 
-* Create a pandas DataFrame with an ID column as well as a column for each dog breed.
-* Add data to the ID column by extracting the test image ID's from their filepaths.
-* Add data (the prediction probabilities) to each of the dog breed columns using the unique_breeds list and the test_predictions list.
-* Export the DataFrame as a CSV to submit it to Kaggle.
+Memory stays flat no matter how many test images there are, and since the ID's come from the same list the batches are made from, they always line up with their predictions. If a long scoring job stops halfway, running it again with `resume=True` only predicts the images which aren't in the file yet. And writing a fresh file for images this model has already predicted just reads the predictions back from the prediction cache.
 """
 
-# Create pandas DataFrame with empty columns
-preds_df = pd.DataFrame(columns=["id"] + list(unique_breeds))
-preds_df.head()
+import shutil
 
-# Append test image ID's to predictions DataFrame
-test_path = "drive/My Drive/Data/test/"
-preds_df["id"] = [os.path.splitext(path)[0] for path in os.listdir(test_path)]
-preds_df.head()
+# Create a function which removes a half written last line (e.g. if the notebook was stopped mid-write)
+def truncate_partial_line(csv_path, chunk_size=64 * 1024):
+  """
+  Cuts a CSV file back to its last complete line, reading backwards from the end in chunks
+  of chunk_size bytes (so a big file isn't read into memory).
+  """
+  with open(csv_path, "rb+") as f:
+    end = f.seek(0, os.SEEK_END)
+    while end > 0:
+      start = max(end - chunk_size, 0)
+      f.seek(start)
+      newline = f.read(end - start).rfind(b"\n")
+      if newline != -1:
+        f.truncate(start + newline + 1)
+        return
+      end = start
+    # No complete line at all
+    f.truncate(0)
+
+# Create a function which writes predictions to a submission file while predicting
+def write_predictions(model, image_paths, output_path, resume=False, data=None, batch_size=BATCH_SIZE,
+                      cache=None, undecodable_paths=()):
+  """
+  Predicts image_paths batch by batch and appends every batch to output_path as soon as it's
+  predicted. Writes a CSV file, or a directory of Parquet part files if output_path ends in .parquet.
+  With resume=True images whose id is already in output_path are skipped.
+
+  data can be (images, ids) batches of the same images (e.g. test batches from
+  create_data_batches_from_tfrecords()), in which case every row gets the id that came with its
+  image, resuming isn't possible and the cache isn't used.
+  Otherwise images already predicted by the same model come from cache (a PredictionCache).
 
-# Add the prediction probabilities to each dog breed column
-preds_df[list(unique_breeds)] = test_predictions
-preds_df.head()
+  Images in undecodable_paths aren't predicted (and shouldn't be in data), they get the same
+  probability for every breed so the file still has a row for them.
+  """
+  parquet = output_path.endswith(".parquet")
+  columns = ["id"] + list(unique_breeds)
+
+  # Find the images which have already been predicted
+  done_ids = set()
+  if not parquet and os.path.exists(output_path):
+    truncate_partial_line(output_path)
+    # Nothing complete was written (not even the header), so start again
+    if os.path.getsize(output_path) == 0:
+      os.remove(output_path)
+  if resume and os.path.exists(output_path):
+    if parquet:
+      done_ids = set(pd.read_parquet(output_path, columns=["id"])["id"])
+    else:
+      done_ids = set(pd.read_csv(output_path, usecols=["id"], dtype=str)["id"])
+  elif os.path.exists(output_path):
+    # Not resuming, so start a fresh file
+    if parquet:
+      shutil.rmtree(output_path)
+    else:
+      os.remove(output_path)
+
+  # The ids come from the same list as the images, so row i of the predictions belongs to ids[i]
+  image_paths = [path for path in image_paths
+                 if os.path.splitext(os.path.basename(path))[0] not in done_ids]
+  # Images which don't decode go first, with uniform probabilities
+  undecodable_paths = set(undecodable_paths)
+  uniform_paths = [path for path in image_paths if path in undecodable_paths]
+  image_paths = [path for path in image_paths if path not in undecodable_paths]
+  ids = [os.path.splitext(os.path.basename(path))[0] for path in uniform_paths + image_paths]
+  print(f"Predicting {len(image_paths)} images ({len(uniform_paths)} don't decode, "
+        f"{len(done_ids)} already in {output_path})...")
+  if not ids:
+    return output_path
+  if data is not None and done_ids:
+    raise ValueError("Can't resume when predicting from data, it would predict every image again")
+
+  # Every chunk is (ids, predictions)
+  def with_ids(predictions, ids):
+    start = 0
+    for batch_predictions in predictions:
+      yield ids[start:start + len(batch_predictions)], batch_predictions
+      start += len(batch_predictions)
+
+  predicted_ids = ids[len(uniform_paths):]
+  if data is not None:
+    # The ids come with the images, so a row can't end up next to the wrong id
+    chunks = (([image_id.decode() for image_id in batch_ids.numpy()], model.predict_on_batch(images))
+              for images, batch_ids in data)
+  elif cache is not None:
+    # Look up (or predict) a few batches at a time, so memory stays flat
+    chunk_size = 10 * batch_size
+    # Hashing every weight is slow, so do it once rather than for every chunk
+    fingerprint = model_fingerprint(model)
+    chunks = with_ids((cache.predict(model, image_paths[i:i + chunk_size], batch_size=batch_size,
+                                     fingerprint=fingerprint)
+                       for i in range(0, len(image_paths), chunk_size)), predicted_ids)
+  else:
+    data = create_data_batches(image_paths, batch_size=batch_size, test_data=True)
+    chunks = with_ids((model.predict_on_batch(batch) for batch in data), predicted_ids)
+  if uniform_paths:
+    uniform = np.full([len(uniform_paths), len(unique_breeds)], 1 / len(unique_breeds), dtype=np.float32)
+    chunks = itertools.chain([(ids[:len(uniform_paths)], uniform)], chunks)
+
+  if parquet:
+    os.makedirs(output_path, exist_ok=True)
+    # Number the new part files after the existing ones
+    part_number = len(os.listdir(output_path))
+
+  written_ids = set()
+  num_rows = 0
+  for batch_ids, batch_predictions in chunks:
+    if len(batch_ids) != len(batch_predictions):
+      raise ValueError(f"Got {len(batch_predictions)} predictions for {len(batch_ids)} ids")
+    written_ids.update(batch_ids)
+    num_rows += len(batch_ids)
+    chunk = pd.DataFrame(batch_predictions, columns=columns[1:])
+    chunk.insert(0, "id", batch_ids)
+
+    if parquet:
+      chunk.to_parquet(os.path.join(output_path, f"part-{part_number:05d}.parquet"), index=False)
+      part_number += 1
+    else:
+      # Only write the header if the file is new
+      chunk.to_csv(output_path, mode="a", header=not os.path.exists(output_path), index=False)
+
+  # Every id has to have exactly one row of predictions
+  if num_rows != len(ids) or written_ids != set(ids):
+    raise ValueError(f"Wrote {num_rows} rows for {len(written_ids)} ids, {len(set(ids) - written_ids)} of the {len(ids)} "
+                     f"images are missing and {len(written_ids - set(ids))} ids aren't in image_paths")
+  return output_path
+
+# Test images which don't decode still get a row in the submission (with the same probability for every breed)
+test_undecodable_paths = list(test_manifest.loc[~test_manifest["decode_ok"], "path"])
+
+# Read the test images (and their ids) from TFRecord shards
+if USE_TFRECORDS:
+  undecodable = set(test_undecodable_paths)
+  test_shards = get_tfrecord_shards([path for path in test_filenames if path not in undecodable],
+                                    prefix="test")
+  test_data = create_data_batches_from_tfrecords(test_shards,
+                                                 batch_size=loaded_full_model_settings["predict_batch_size"],
+                                                 test_data=True)
+else:
+  test_data = None
+
+# Predict the test images with the loaded full model and write the submission as we go
+submission_path = write_predictions(loaded_full_model,
+                                    test_filenames,
+                                    "drive/My Drive/Data/full_submission_1_mobilienetV2_adam.csv",
+                                    resume=not USE_TFRECORDS,
+                                    data=test_data,
+                                    batch_size=loaded_full_model_settings["predict_batch_size"],
+                                    cache=prediction_cache,
+                                    undecodable_paths=test_undecodable_paths)
+
+# Check out the test predictions
+pd.read_csv(submission_path, nrows=10)
 
-preds_df.to_csv("drive/My Drive/Data/full_submission_1_mobilienetV2_adam.csv",
-                 index=False)
+# How many test predictions came from the prediction cache? (writing the submission again is all hits)
+prediction_cache.stats()
 
 """##Making predictions on custom images
 It's great being able to make predictions on a test dataset already provided for us.
@@ -770,14 +3110,16 @@ custom_image_paths = [custom_path + fname for fname in os.listdir(custom_path)]
 # Turn custom image into batch (set to test data because there are no labels)
 custom_data = create_data_batches(custom_image_paths, test_data=True)
 
-# Make predictions on the custom data
-custom_preds = loaded_full_model.predict(custom_data)
+# Make predictions on the custom data (images we've predicted with this model before come from the cache)
+custom_preds = prediction_cache.predict(loaded_full_predictor, custom_image_paths)
+prediction_cache.stats()
 
 # Get custom image prediction labels
-custom_pred_labels = [get_pred_label(custom_preds[i]) for i in range(len(custom_preds))]
+_, custom_pred_labels, _ = decode_predictions(custom_preds, k=1)
+custom_pred_labels = custom_pred_labels[:, 0]
 custom_pred_labels
 
-# Get custom images (our unbatchify() function won't work since there aren't labels)
+# Get custom images (there are only a few of them, so keeping them in a list is fine)
 custom_images = []
 # Loop through unbatched data
 for image in custom_data.unbatch().as_numpy_iterator():
@@ -0,0 +1,88 @@
+"""
+Sends concurrent prediction requests to serve.py and reports latency and throughput.
+
+Usage:
+  python serve.py --model ... &
+  python load_test.py --images "drive/My Drive/Data/dogs/" --concurrency 16 --requests 1000
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+import urllib.request
+
+import numpy as np
+
+def send_image(url, image_bytes):
+  """
+  POSTs one image to the server and returns the parsed JSON response.
+  """
+  request = urllib.request.Request(url, data=image_bytes, headers={"Content-Type": "image/jpeg"})
+  with urllib.request.urlopen(request) as response:
+    return json.load(response)
+
+def run_load_test(url, images, num_requests, concurrency):
+  """
+  Sends num_requests requests from concurrency threads (cycling through images) and
+  returns the latency of each request in seconds plus the total time taken.
+  """
+  latencies = []
+  errors = []
+  lock = threading.Lock()
+  # The threads share one iterator of request numbers (next() on a range iterator is safe under the GIL)
+  counter = iter(range(num_requests))
+
+  def worker():
+    for i in counter:
+      start = time.monotonic()
+      try:
+        send_image(url, images[i % len(images)])
+      except Exception as e:
+        with lock:
+          errors.append(e)
+        continue
+      with lock:
+        latencies.append(time.monotonic() - start)
+
+  start = time.monotonic()
+  threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return np.array(latencies), errors, time.monotonic() - start
+
+def main():
+  parser = argparse.ArgumentParser(description="Load test the dog breed prediction server.")
+  parser.add_argument("--server", default="http://127.0.0.1:8000")
+  parser.add_argument("--images", default=".", help="Directory of .jpg/.jpeg images to send")
+  parser.add_argument("--requests", type=int, default=500)
+  parser.add_argument("--concurrency", type=int, default=16)
+  parser.add_argument("--top_k", type=int, default=5)
+  args = parser.parse_args()
+
+  image_paths = [os.path.join(args.images, fname) for fname in sorted(os.listdir(args.images))
+                 if fname.lower().endswith((".jpg", ".jpeg"))]
+  images = []
+  for image_path in image_paths:
+    with open(image_path, "rb") as f:
+      images.append(f.read())
+  print(f"Sending {args.requests} requests with {len(images)} images from {args.concurrency} threads...")
+
+  latencies, errors, elapsed = run_load_test(f"{args.server}/predict?top_k={args.top_k}", images,
+                                             args.requests, args.concurrency)
+  latencies_ms = latencies * 1000
+  print(f"Completed: {len(latencies)}, errors: {len(errors)}")
+  print(f"Throughput: {len(latencies) / elapsed:.1f} images/sec")
+  if len(latencies):
+    print(f"Client latency p50: {np.percentile(latencies_ms, 50):.1f} ms, "
+          f"p99: {np.percentile(latencies_ms, 99):.1f} ms")
+
+  # What the server saw (including how well requests were batched)
+  with urllib.request.urlopen(f"{args.server}/stats") as response:
+    print("Server stats:", json.dumps(json.load(response), indent=2))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,133 @@
+"""
+Streaming evaluation metrics for multi-class predictions, in NumPy.
+
+StreamingMetrics is updated with one batch of prediction probabilities and labels at a time and
+only keeps running totals, so memory doesn't grow with the number of predictions:
+* log loss (the way Kaggle scores the competition),
+* top-1 and top-5 accuracy,
+* a confusion matrix (true class x predicted class) with per-class precision and recall,
+* expected calibration error (ECE) over confidence bins.
+
+Every update is vectorized over the batch (no Python loop over predictions).
+
+top_k_predictions() picks the k most likely classes of every row (used by decode_predictions()
+in dog_vision.py and by predict.py, which doesn't load the notebook).
+
+Usage:
+  metrics = StreamingMetrics(num_classes=120)
+  for probabilities, labels in batches:
+    metrics.update(probabilities, labels)
+  metrics.result()
+"""
+
+import numpy as np
+
+def top_k_predictions(probabilities, k):
+  """
+  Returns the indexes and probabilities of the k most likely classes of every row of an
+  (N, classes) array (each of shape (N, k)), most likely first.
+  """
+  probabilities = np.asarray(probabilities)
+  if not 1 <= k <= probabilities.shape[1]:
+    raise ValueError(f"k has to be from 1 to {probabilities.shape[1]}, got {k}")
+  # Find the top k of each row without sorting the whole row (they come back in no particular order)
+  top_k_indexes = np.argpartition(probabilities, -k, axis=1)[:, -k:]
+  top_k_probabilities = np.take_along_axis(probabilities, top_k_indexes, axis=1)
+  # Sort only those k, highest probability first
+  order = np.argsort(-top_k_probabilities, axis=1)
+  return np.take_along_axis(top_k_indexes, order, axis=1), np.take_along_axis(top_k_probabilities, order, axis=1)
+
+class StreamingMetrics:
+  """
+  Running totals for log loss, top-k accuracy, the confusion matrix and calibration.
+  Labels can be class indexes or one-hot (or boolean) rows.
+  """
+  def __init__(self, num_classes, top_k=(1, 5), num_bins=15, eps=1e-15):
+    self.num_classes = num_classes
+    self.top_k = top_k
+    self.num_bins = num_bins
+    self.eps = eps
+    self.count = 0
+    self.log_loss_sum = 0.0
+    self.top_k_correct = np.zeros(len(top_k), dtype=np.int64)
+    self.confusion_matrix = np.zeros([num_classes, num_classes], dtype=np.int64)
+    # Per confidence bin: number of predictions, sum of their confidences and number correct
+    self.bin_counts = np.zeros(num_bins, dtype=np.int64)
+    self.bin_confidence_sums = np.zeros(num_bins)
+    self.bin_correct = np.zeros(num_bins, dtype=np.int64)
+
+  def update(self, probabilities, labels):
+    """
+    Adds a batch of prediction probabilities (batch x classes) and their true labels.
+    """
+    probabilities = np.asarray(probabilities)
+    labels = np.asarray(labels)
+    if labels.ndim == 2:
+      labels = labels.argmax(axis=1)
+    labels = labels.astype(np.int64)
+    rows = np.arange(len(labels))
+    true_probabilities = probabilities[rows, labels]
+
+    # Kaggle clips the probabilities and rescales every row to sum to 1 before taking the log
+    clipped = np.clip(probabilities, self.eps, 1 - self.eps)
+    clipped_true = clipped[rows, labels] / clipped.sum(axis=1)
+    self.log_loss_sum -= np.log(clipped_true).sum(dtype=np.float64)
+
+    # The true class is in the top k if fewer than k classes come before it. Ties go to the lower
+    # class index, like argmax (so top-1 accuracy matches the diagonal of the confusion matrix)
+    true_probabilities = true_probabilities[:, np.newaxis]
+    tied_before = (probabilities == true_probabilities) & (np.arange(self.num_classes) < labels[:, np.newaxis])
+    rank = (probabilities > true_probabilities).sum(axis=1) + tied_before.sum(axis=1)
+    self.top_k_correct += (rank[:, np.newaxis] < np.array(self.top_k)).sum(axis=0)
+
+    predictions = probabilities.argmax(axis=1)
+    self.confusion_matrix += np.bincount(labels * self.num_classes + predictions,
+                                         minlength=self.num_classes ** 2).reshape(self.num_classes, self.num_classes)
+
+    confidences = probabilities[rows, predictions]
+    bins = np.minimum((confidences * self.num_bins).astype(np.int64), self.num_bins - 1)
+    self.bin_counts += np.bincount(bins, minlength=self.num_bins)
+    self.bin_confidence_sums += np.bincount(bins, weights=confidences, minlength=self.num_bins)
+    self.bin_correct += np.bincount(bins, weights=predictions == labels, minlength=self.num_bins).astype(np.int64)
+    self.count += len(labels)
+
+  def expected_calibration_error(self):
+    """
+    Returns the average gap between confidence and accuracy over the confidence bins,
+    weighted by the number of predictions in each bin.
+    """
+    counts = np.maximum(self.bin_counts, 1)
+    gaps = np.abs(self.bin_confidence_sums / counts - self.bin_correct / counts)
+    return float((gaps * self.bin_counts).sum() / max(self.count, 1))
+
+  def per_class(self):
+    """
+    Returns a dict of per-class arrays: support (number of true labels), precision and recall.
+    """
+    correct = np.diag(self.confusion_matrix)
+    support = self.confusion_matrix.sum(axis=1)
+    predicted = self.confusion_matrix.sum(axis=0)
+    return {"support": support,
+            "precision": correct / np.maximum(predicted, 1),
+            "recall": correct / np.maximum(support, 1)}
+
+  def reliability(self):
+    """
+    Returns a dict of per-bin arrays for a reliability diagram: bin edges, count, mean confidence and accuracy.
+    """
+    counts = np.maximum(self.bin_counts, 1)
+    return {"bin edges": np.linspace(0, 1, self.num_bins + 1),
+            "count": self.bin_counts,
+            "mean confidence": self.bin_confidence_sums / counts,
+            "accuracy": self.bin_correct / counts}
+
+  def result(self):
+    """
+    Returns a dict of the overall metrics.
+    """
+    count = max(self.count, 1)
+    result = {"count": self.count, "log loss": self.log_loss_sum / count}
+    for k, correct in zip(self.top_k, self.top_k_correct):
+      result[f"top-{k} accuracy"] = correct / count
+    result["ece"] = self.expected_calibration_error()
+    return result
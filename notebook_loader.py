@@ -0,0 +1,66 @@
+"""
+Loads the functions and constants defined in dog_vision.py without running its cells.
+
+dog_vision.py is exported from a Colab notebook, so importing it would read Drive, train
+models and plot images. Scripts use load_notebook() instead: it only runs the imports,
+function and class definitions and UPPERCASE constants (IMG_SIZE, BATCH_SIZE, MODEL_URL...)
+so the scripts use exactly the same preprocessing and model code as the notebook.
+"""
+
+import ast
+import os
+
+NOTEBOOK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dog_vision.py")
+
+class Notebook:
+  """
+  Gives attribute access to the globals the notebook functions run with, so
+  setting an attribute (e.g. notebook.train_data = ...) is seen by the functions too.
+  """
+  def __init__(self, namespace):
+    object.__setattr__(self, "_namespace", namespace)
+
+  def __getattr__(self, name):
+    try:
+      return self._namespace[name]
+    except KeyError:
+      raise AttributeError(name) from None
+
+  def __setattr__(self, name, value):
+    self._namespace[name] = value
+
+def is_constant(node):
+  """
+  Checks if a statement assigns to UPPERCASE names only (e.g. IMG_SIZE = 224).
+  """
+  return (isinstance(node, ast.Assign) and
+          all(isinstance(target, ast.Name) and target.id.isupper() for target in node.targets))
+
+def load_notebook(path=NOTEBOOK_PATH, **overrides):
+  """
+  Runs the definitions from the notebook and returns them as a Notebook.
+
+  overrides are set before anything runs and their assignments in the notebook are skipped,
+  so e.g. load_notebook(unique_breeds=..., IMG_SIZE=160) changes OUTPUT_SHAPE, INPUT_SHAPE
+  and the default img_size of process_image() too.
+  """
+  with open(path) as f:
+    tree = ast.parse(f.read(), filename=path)
+
+  namespace = {"__name__": "dog_vision", "__file__": path}
+  namespace.update(overrides)
+  for node in tree.body:
+    if is_constant(node):
+      if any(target.id in overrides for target in node.targets):
+        continue
+    elif not isinstance(node, (ast.Import, ast.ImportFrom, ast.FunctionDef, ast.ClassDef)):
+      continue
+    code = compile(ast.Module(body=[node], type_ignores=[]), path, "exec")
+    try:
+      exec(code, namespace)
+    except ImportError as e:
+      # Notebook-only imports (e.g. IPython.display) aren't needed by scripts
+      if not isinstance(node, (ast.Import, ast.ImportFrom)):
+        raise
+      print(f"Skipping notebook import: {e}")
+  return Notebook(namespace)
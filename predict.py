@@ -0,0 +1,116 @@
+"""
+Predicts dog breeds for image files with a SavedModel exported by export_saved_model().
+
+Made to start fast: it doesn't run or load dog_vision.py (no pandas, matplotlib, sklearn or
+TensorFlow Hub), only imports TensorFlow when a model is loaded, doesn't read labels.csv
+(the breed names are saved next to the model) and warms the model up when it's loaded.
+
+Usage:
+  python predict.py --model "drive/My Drive/Data/models/all-images-Adam-savedmodel" "dogsample .jpeg"
+
+From Python:
+  predictor = BreedPredictor("drive/My Drive/Data/models/all-images-Adam-savedmodel")
+  predictor.predict_files(["dogsample .jpeg"], top_k=3)
+"""
+
+import time
+
+# Measure time to first prediction from when the script starts
+START_TIME = time.perf_counter()
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from metrics import top_k_predictions
+
+# Must match BREEDS_FILENAME and model_settings_path() in dog_vision.py
+BREEDS_FILENAME = "breeds.txt"
+SETTINGS_FILENAME = "settings.json"
+
+def load_breeds(export_dir):
+  """
+  Returns the breed names saved next to an exported model, in the order of its outputs.
+  """
+  with open(os.path.join(export_dir, BREEDS_FILENAME)) as f:
+    return np.array(f.read().splitlines())
+
+class BreedPredictor:
+  """
+  Loads an exported SavedModel once and predicts the top k breeds of JPEG files.
+  """
+  def __init__(self, export_dir, warm_up=True):
+    # Imported here so importing this module (or --help) doesn't pay for importing TensorFlow
+    import tensorflow as tf
+    self.tf = tf
+    self.predict_jpeg = tf.saved_model.load(export_dir).signatures["predict_jpeg"]
+    self.breeds = load_breeds(export_dir)
+    # Predict in batches of the size picked when the model was trained
+    self.batch_size = 32
+    settings_path = os.path.join(export_dir, SETTINGS_FILENAME)
+    if os.path.exists(settings_path):
+      with open(settings_path) as f:
+        self.batch_size = json.load(f)["predict_batch_size"]
+    if warm_up:
+      self.warm_up()
+
+  def warm_up(self):
+    """
+    Runs one tiny image through the model so the first real prediction isn't slowed down by setup.
+    """
+    image = self.tf.io.encode_jpeg(self.tf.zeros([8, 8, 3], dtype=self.tf.uint8))
+    self.predict_bytes([image.numpy()])
+
+  def predict_bytes(self, images):
+    """
+    Returns the prediction probabilities for a list of JPEG file contents.
+    """
+    return np.concatenate([self.predict_jpeg(images=self.tf.constant(images[i:i + self.batch_size]))["probabilities"].numpy()
+                           for i in range(0, len(images), self.batch_size)])
+
+  def predict_files(self, image_paths, top_k=5):
+    """
+    Returns a list with the top_k (breed, probability) pairs of every image file, most likely first.
+    """
+    # Check top_k before spending time on predictions
+    if not 1 <= top_k <= len(self.breeds):
+      raise ValueError(f"top_k has to be from 1 to {len(self.breeds)}, got {top_k}")
+    images = []
+    for image_path in image_paths:
+      with open(image_path, "rb") as f:
+        images.append(f.read())
+    top_k_indexes, top_k_probabilities = top_k_predictions(self.predict_bytes(images), top_k)
+    return [list(zip(self.breeds[indexes], row_probabilities))
+            for indexes, row_probabilities in zip(top_k_indexes, top_k_probabilities)]
+
+def main():
+  parser = argparse.ArgumentParser(description="Predict dog breeds of JPEG images.")
+  parser.add_argument("images", nargs="+", help="JPEG files to predict")
+  parser.add_argument("--model", required=True, help="Directory written by export_saved_model()")
+  parser.add_argument("--top_k", type=int, default=3)
+  args = parser.parse_args()
+  # Check the arguments before paying for loading the model
+  if not os.path.isdir(args.model):
+    parser.error(f"--model {args.model} isn't a directory")
+  num_breeds = len(load_breeds(args.model))
+  if not 1 <= args.top_k <= num_breeds:
+    parser.error(f"--top_k has to be from 1 to {num_breeds}, got {args.top_k}")
+  missing = [image_path for image_path in args.images if not os.path.isfile(image_path)]
+  if missing:
+    parser.error(f"can't find: {', '.join(missing)}")
+
+  load_start = time.perf_counter()
+  predictor = BreedPredictor(args.model)
+  load_time = time.perf_counter() - load_start
+
+  predictions = predictor.predict_files(args.images, top_k=args.top_k)
+  first_prediction_time = time.perf_counter() - START_TIME
+  for image_path, top_k in zip(args.images, predictions):
+    print(image_path + ": " + ", ".join(f"{breed} ({probability:.1%})" for breed, probability in top_k))
+  print(f"Loaded model (with warm up) in {load_time:.2f}s, "
+        f"time to first prediction: {first_prediction_time:.2f}s")
+
+if __name__ == "__main__":
+  main()
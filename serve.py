@@ -0,0 +1,227 @@
+"""
+Serves dog breed predictions from a saved model over HTTP.
+
+The model is loaded once with load_model() from dog_vision.py. Each request POSTs the raw
+bytes of one JPEG to /predict, concurrent requests are grouped into micro-batches (at most
+--max_batch_size images, waiting at most --max_wait_ms for a batch to fill up) and every
+request gets back the top k breeds. GET /stats returns latency and throughput counters.
+The model is traced for every micro-batch size up front (CompiledPredictor), optionally
+compiled with XLA (--jit_compile).
+
+Usage:
+  python serve.py --model "drive/My Drive/Data/models/...-all-images-Adam.h5" --labels "drive/My Drive/Dog-vision/labels.csv"
+  curl --data-binary @"dogsample .jpeg" "localhost:8000/predict?top_k=5"
+"""
+
+import argparse
+import collections
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from notebook_loader import load_notebook
+
+class LatencyStats:
+  """
+  Keeps request latencies, batch sizes and counts for the /stats endpoint.
+  """
+  def __init__(self, window=10000):
+    self.lock = threading.Lock()
+    self.start_time = time.monotonic()
+    # Only the most recent latencies are kept so memory stays bounded
+    self.latencies = collections.deque(maxlen=window)
+    self.num_requests = 0
+    self.num_client_errors = 0
+    self.num_server_errors = 0
+    self.num_batches = 0
+    self.num_batched_images = 0
+
+  def record_request(self, latency, error=None):
+    """
+    Records a request, error is None, "client" (a bad request) or "server" (a failure predicting it).
+    """
+    with self.lock:
+      self.latencies.append(latency)
+      self.num_requests += 1
+      self.num_client_errors += error == "client"
+      self.num_server_errors += error == "server"
+
+  def record_batch(self, batch_size):
+    with self.lock:
+      self.num_batches += 1
+      self.num_batched_images += batch_size
+
+  def summary(self):
+    with self.lock:
+      latencies = np.array(self.latencies) * 1000
+      elapsed = time.monotonic() - self.start_time
+      return {
+          "requests": self.num_requests,
+          "errors": self.num_client_errors + self.num_server_errors,
+          "client_errors": self.num_client_errors,
+          "server_errors": self.num_server_errors,
+          "batches": self.num_batches,
+          "mean_batch_size": self.num_batched_images / max(self.num_batches, 1),
+          "requests_per_second": self.num_requests / elapsed,
+          "p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else None,
+          "p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else None,
+      }
+
+class MicroBatcher:
+  """
+  Groups images from concurrent requests into batches and runs the model on them from one thread.
+  """
+  def __init__(self, model, max_batch_size=32, max_wait_ms=5, stats=None):
+    self.model = model
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000
+    self.stats = stats or LatencyStats()
+    self.requests = queue.Queue()
+    threading.Thread(target=self.run, daemon=True).start()
+
+  def predict(self, image):
+    """
+    Queues one preprocessed image and blocks until its prediction probabilities are ready.
+    """
+    request = {"image": image, "done": threading.Event()}
+    self.requests.put(request)
+    request["done"].wait()
+    if "error" in request:
+      raise request["error"]
+    return request["probabilities"]
+
+  def next_batch(self):
+    """
+    Waits for a first request, then collects more until the batch is full or max_wait has passed.
+    """
+    batch = [self.requests.get()]
+    deadline = time.monotonic() + self.max_wait
+    while len(batch) < self.max_batch_size:
+      timeout = deadline - time.monotonic()
+      if timeout <= 0:
+        break
+      try:
+        batch.append(self.requests.get(timeout=timeout))
+      except queue.Empty:
+        break
+    return batch
+
+  def run(self):
+    while True:
+      batch = self.next_batch()
+      try:
+        probabilities = self.model.predict_on_batch(np.stack([request["image"] for request in batch]))
+        for request, request_probabilities in zip(batch, np.asarray(probabilities)):
+          request["probabilities"] = request_probabilities
+      except Exception as e:
+        for request in batch:
+          request["error"] = e
+      self.stats.record_batch(len(batch))
+      for request in batch:
+        request["done"].set()
+
+def top_k_breeds(notebook, probabilities, k=5):
+  """
+  Returns the k most likely breeds and their probabilities, most likely first.
+  """
+  _, top_k_labels, top_k_probabilities = notebook.decode_predictions(probabilities[np.newaxis], k=k)
+  return [{"breed": str(label), "probability": float(probability)}
+          for label, probability in zip(top_k_labels[0], top_k_probabilities[0])]
+
+def create_handler(notebook, batcher, default_top_k=5):
+  """
+  Builds the request handler class for the HTTP server.
+  """
+  class PredictionHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+      data = json.dumps(body).encode()
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+    def do_GET(self):
+      if urlparse(self.path).path == "/stats":
+        self.send_json(200, batcher.stats.summary())
+      else:
+        self.send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+      url = urlparse(self.path)
+      if url.path != "/predict":
+        self.send_json(404, {"error": "not found"})
+        return
+      start = time.monotonic()
+      # Bad requests (arguments or images) are the client's fault
+      try:
+        top_k = int(parse_qs(url.query).get("top_k", [default_top_k])[0])
+        if not 1 <= top_k <= notebook.OUTPUT_SHAPE:
+          raise ValueError(f"top_k has to be from 1 to {notebook.OUTPUT_SHAPE}, got {top_k}")
+        if self.headers["Content-Length"] is None:
+          raise ValueError("Content-Length is missing")
+        image_bytes = self.rfile.read(int(self.headers["Content-Length"]))
+        # Decode in the request thread so several images decode at once while the model runs
+        image = notebook.decode_image(image_bytes).numpy()
+      except (ValueError, tf.errors.InvalidArgumentError) as e:
+        batcher.stats.record_request(time.monotonic() - start, error="client")
+        self.send_json(400, {"error": str(e)})
+        return
+      # Anything going wrong from here on is the server's
+      try:
+        probabilities = batcher.predict(image)
+      except Exception as e:
+        batcher.stats.record_request(time.monotonic() - start, error="server")
+        self.send_json(500, {"error": str(e)})
+        return
+      latency = time.monotonic() - start
+      batcher.stats.record_request(latency)
+      self.send_json(200, {"predictions": top_k_breeds(notebook, probabilities, top_k),
+                           "latency_ms": latency * 1000})
+
+    def log_message(self, format, *args):
+      # Logging every request would slow the server down
+      pass
+
+  return PredictionHandler
+
+def main():
+  parser = argparse.ArgumentParser(description="Serve dog breed predictions over HTTP.")
+  parser.add_argument("--model", required=True, help="Path of a model written by save_model()")
+  parser.add_argument("--labels", default="drive/My Drive/Dog-vision/labels.csv",
+                      help="labels.csv the model was trained on (gives the breed names)")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8000)
+  parser.add_argument("--max_batch_size", type=int, default=None,
+                      help="Defaults to the predict batch size saved with the model")
+  parser.add_argument("--max_wait_ms", type=float, default=5)
+  parser.add_argument("--jit_compile", action="store_true", help="Compile the model with XLA")
+  parser.add_argument("--top_k", type=int, default=5)
+  args = parser.parse_args()
+
+  # The breeds in the same (sorted) order the model was trained with
+  unique_breeds = np.unique(pd.read_csv(args.labels)["breed"])
+  notebook = load_notebook(unique_breeds=unique_breeds)
+  if not 1 <= args.top_k <= notebook.OUTPUT_SHAPE:
+    parser.error(f"--top_k has to be from 1 to {notebook.OUTPUT_SHAPE}")
+  model = notebook.load_model(args.model)
+  max_batch_size = args.max_batch_size or notebook.load_model_settings(args.model)["predict_batch_size"]
+
+  # Trace the model for every batch size up to max_batch_size now, so no request pays for it
+  buckets = [bucket for bucket in notebook.PREDICT_BUCKETS if bucket < max_batch_size] + [max_batch_size]
+  model = notebook.CompiledPredictor(model, buckets=buckets, jit_compile=args.jit_compile)
+
+  batcher = MicroBatcher(model, max_batch_size=max_batch_size, max_wait_ms=args.max_wait_ms)
+  server = ThreadingHTTPServer((args.host, args.port), create_handler(notebook, batcher, args.top_k))
+  print(f"Serving predictions on http://{args.host}:{args.port}/predict...")
+  server.serve_forever()
+
+if __name__ == "__main__":
+  main()
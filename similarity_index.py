@@ -0,0 +1,220 @@
+"""
+Approximate nearest neighbour index for finding visually similar dogs, in NumPy.
+
+IVFIndex is an inverted file index: k-means splits the embeddings into num_lists groups
+(lists) and a query only compares against the vectors in the nprobe lists whose centroids
+are closest to it, instead of against every vector. Vectors are compared by cosine
+similarity. Vectors can be added at any time, and the index can be saved to a directory and
+loaded back with its vectors memory-mapped.
+
+Usage:
+  index = IVFIndex(dim=embeddings.shape[1])
+  index.train(embeddings)
+  index.add(embeddings, ids, breeds)
+  ids, breeds, similarities = index.search(query_embeddings, k=10)
+"""
+
+import json
+import os
+import time
+
+import numpy as np
+
+def normalize(vectors):
+  """
+  Scales every row to length 1, so the dot product of two rows is their cosine similarity.
+  """
+  vectors = np.asarray(vectors, dtype=np.float32)
+  return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+def top_k(similarities, k):
+  """
+  Returns the column indexes of the k largest values of every row, largest first.
+  """
+  k = min(k, similarities.shape[1])
+  indexes = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+  order = np.argsort(-np.take_along_axis(similarities, indexes, axis=1), axis=1)
+  return np.take_along_axis(indexes, order, axis=1)
+
+def exact_search(vectors, queries, k=10):
+  """
+  Brute force search: returns the row indexes and cosine similarities of the k most similar vectors to every query.
+  """
+  similarities = normalize(queries) @ normalize(vectors).T
+  indexes = top_k(similarities, k)
+  return indexes, np.take_along_axis(similarities, indexes, axis=1)
+
+class IVFIndex:
+  """
+  Inverted file index over embeddings, with ids and breeds stored for every vector.
+  """
+  def __init__(self, dim, num_lists=64):
+    self.dim = dim
+    self.num_lists = num_lists
+    self.centroids = None
+    self.size = 0
+    # Space for the vectors is doubled whenever it runs out, so adding is cheap on average
+    self.vectors = np.zeros([0, dim], dtype=np.float32)
+    self.list_assignments = np.zeros([0], dtype=np.int32)
+    self.ids = []
+    self.breeds = []
+    # The vectors sorted by list (each list a contiguous slice), rebuilt lazily after adds
+    self.list_vectors = None
+
+  def train(self, vectors, num_iterations=20, sample_size=50000, seed=42):
+    """
+    Finds num_lists centroids with (spherical) k-means on a sample of vectors.
+    """
+    rng = np.random.default_rng(seed)
+    vectors = normalize(vectors)
+    if len(vectors) > sample_size:
+      vectors = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    num_lists = min(self.num_lists, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), num_lists, replace=False)]
+    for _ in range(num_iterations):
+      assignments = np.argmax(vectors @ centroids.T, axis=1)
+      # New centroid = mean direction of its vectors (empty lists keep their old centroid)
+      sums = np.zeros_like(centroids)
+      np.add.at(sums, assignments, vectors)
+      counts = np.bincount(assignments, minlength=num_lists)
+      centroids = np.where(counts[:, np.newaxis] > 0, normalize(sums), centroids)
+    self.centroids = centroids
+    self.num_lists = num_lists
+    return self
+
+  def add(self, vectors, ids, breeds=None):
+    """
+    Adds vectors with their ids (and breeds) to the index.
+    """
+    if self.centroids is None:
+      raise ValueError("Train the index before adding vectors to it")
+    vectors = normalize(vectors)
+    new_size = self.size + len(vectors)
+    if new_size > len(self.vectors) or not self.vectors.flags.writeable:
+      capacity = max(new_size, 2 * len(self.vectors))
+      # Copies memory-mapped (read only) vectors into memory too
+      self.vectors = np.concatenate([self.vectors[:self.size],
+                                     np.zeros([capacity - self.size, self.dim], dtype=np.float32)])
+      self.list_assignments = np.concatenate([self.list_assignments[:self.size],
+                                              np.zeros(capacity - self.size, dtype=np.int32)])
+    self.vectors[self.size:new_size] = vectors
+    self.list_assignments[self.size:new_size] = np.argmax(vectors @ self.centroids.T, axis=1)
+    self.ids.extend(ids)
+    self.breeds.extend(breeds if breeds is not None else [""] * len(vectors))
+    self.size = new_size
+    self.list_vectors = None
+    return self
+
+  def build_lists(self):
+    """
+    Sorts the vectors by list, so every list is one contiguous block of list_vectors.
+    """
+    assignments = self.list_assignments[:self.size]
+    order = np.argsort(assignments, kind="stable")
+    # A loaded index is saved in list order already, so its (memory-mapped) vectors are used as they are
+    if np.array_equal(order, np.arange(self.size)):
+      self.list_vectors = self.vectors[:self.size]
+    else:
+      self.list_vectors = self.vectors[order]
+    self.list_rows = order
+    self.list_bounds = np.searchsorted(assignments[order], np.arange(self.num_lists + 1))
+    self.id_array = np.array(self.ids + [None], dtype=object)
+    self.breed_array = np.array(self.breeds + [None], dtype=object)
+
+  def search(self, queries, k=10, nprobe=8):
+    """
+    Returns the ids, breeds and cosine similarities of the (approximately) k most similar
+    vectors to every query, searching the nprobe closest lists. Rows are padded with
+    None/-inf if fewer than k vectors were searched.
+    """
+    if self.list_vectors is None:
+      self.build_lists()
+    queries = normalize(queries)
+    nprobe = min(nprobe, self.num_lists)
+    # The closest lists of every query, in one matrix product
+    probes = top_k(queries @ self.centroids.T, nprobe)
+
+    # (query, list) pairs grouped by list, so each list is compared with all of its queries at once
+    pair_queries = np.repeat(np.arange(len(queries)), nprobe)
+    pair_lists = probes.ravel()
+    order = np.argsort(pair_lists, kind="stable")
+    pair_queries, pair_lists = pair_queries[order], pair_lists[order]
+    group_bounds = np.searchsorted(pair_lists, np.arange(self.num_lists + 1))
+
+    best_similarities = np.full([len(queries), k], -np.inf, dtype=np.float32)
+    # Position in list_vectors of each result (-1 for none)
+    best_positions = np.full([len(queries), k], -1, dtype=np.int64)
+    for list_index in np.flatnonzero(np.diff(group_bounds)):
+      start, end = self.list_bounds[list_index], self.list_bounds[list_index + 1]
+      if start == end:
+        continue
+      group = pair_queries[group_bounds[list_index]:group_bounds[list_index + 1]]
+      similarities = queries[group] @ self.list_vectors[start:end].T
+      candidates = top_k(similarities, k)
+      # Merge this list's best with the best so far
+      merged_similarities = np.concatenate([best_similarities[group],
+                                            np.take_along_axis(similarities, candidates, axis=1)], axis=1)
+      merged_positions = np.concatenate([best_positions[group], candidates + start], axis=1)
+      keep = top_k(merged_similarities, k)
+      best_similarities[group] = np.take_along_axis(merged_similarities, keep, axis=1)
+      best_positions[group] = np.take_along_axis(merged_positions, keep, axis=1)
+
+    # -1 (no result) picks the None at the end of id_array and breed_array
+    rows = np.where(best_positions >= 0, self.list_rows[best_positions], -1)
+    return self.id_array[rows].tolist(), self.breed_array[rows].tolist(), best_similarities
+
+  def save(self, directory):
+    """
+    Saves the index to a directory (vectors as a .npy file which load() memory-maps), with the
+    vectors sorted by list so a loaded index searches them without copying.
+    """
+    if self.list_vectors is None:
+      self.build_lists()
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, "vectors.npy"), self.list_vectors)
+    np.save(os.path.join(directory, "list_assignments.npy"), self.list_assignments[:self.size][self.list_rows])
+    np.save(os.path.join(directory, "centroids.npy"), self.centroids)
+    with open(os.path.join(directory, "metadata.json"), "w") as f:
+      json.dump({"dim": self.dim, "num_lists": self.num_lists,
+                 "ids": self.id_array[self.list_rows].tolist(),
+                 "breeds": self.breed_array[self.list_rows].tolist()}, f)
+    return directory
+
+  @classmethod
+  def load(cls, directory, mmap=True):
+    """
+    Loads an index saved with save(), memory-mapping its vectors unless mmap=False.
+    """
+    with open(os.path.join(directory, "metadata.json")) as f:
+      metadata = json.load(f)
+    index = cls(metadata["dim"], metadata["num_lists"])
+    index.vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r" if mmap else None)
+    index.list_assignments = np.load(os.path.join(directory, "list_assignments.npy"))
+    index.centroids = np.load(os.path.join(directory, "centroids.npy"))
+    index.ids = metadata["ids"]
+    index.breeds = metadata["breeds"]
+    index.size = len(index.vectors)
+    return index
+
+def recall_latency_benchmark(index, queries, k=10, nprobes=(1, 2, 4, 8, 16, 32)):
+  """
+  Compares the index at several nprobe values against exact search: recall@k (how many of the
+  true k nearest neighbours it finds) and milliseconds per query. Returns a list of rows.
+  """
+  # The stored vectors are normalized already
+  vectors = index.vectors[:index.size]
+  start = time.perf_counter()
+  exact_indexes = top_k(normalize(queries) @ vectors.T, k)
+  exact_ms = (time.perf_counter() - start) / len(queries) * 1000
+  exact_ids = [set(index.ids[row] for row in rows) for rows in exact_indexes]
+
+  rows = [{"method": "exact", "nprobe": index.num_lists, "recall@k": 1.0, "ms/query": exact_ms}]
+  for nprobe in nprobes:
+    if nprobe > index.num_lists:
+      break
+    start = time.perf_counter()
+    ids, _, _ = index.search(queries, k=k, nprobe=nprobe)
+    ms = (time.perf_counter() - start) / len(queries) * 1000
+    recall = np.mean([len(exact & set(found)) / len(exact) for exact, found in zip(exact_ids, ids)])
+    rows.append({"method": "ivf", "nprobe": nprobe, "recall@k": float(recall), "ms/query": ms})
+  return rows
@@ -0,0 +1,155 @@
+"""
+Trains the dog breed model on several local worker processes with MultiWorkerMirroredStrategy.
+
+The launcher starts --num_workers copies of this script on localhost, each with its own
+TF_CONFIG. Every worker runs train_model() from dog_vision.py with the strategy, reads its own
+shard of the images and batches BATCH_SIZE images per worker (so the global batch size is
+BATCH_SIZE times the number of workers). Worker 0 writes the results.
+
+Usage:
+  python train_distributed.py --num_workers 4
+  python train_distributed.py --scaling 1,2,4    # prints a scaling efficiency table
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+def free_ports(count):
+  """
+  Finds count free ports on localhost for the workers to talk to each other on.
+  """
+  sockets = [socket.socket() for _ in range(count)]
+  for s in sockets:
+    s.bind(("localhost", 0))
+  ports = [s.getsockname()[1] for s in sockets]
+  for s in sockets:
+    s.close()
+  return ports
+
+def launch_workers(num_workers, worker_args, results_path):
+  """
+  Starts num_workers local worker processes, waits for them and returns worker 0's results.
+  """
+  workers = [f"localhost:{port}" for port in free_ports(num_workers)]
+  # Split the CPU cores between the workers so they don't fight over them
+  threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+  processes = []
+  for index in range(num_workers):
+    env = dict(os.environ,
+               TF_CONFIG=json.dumps({"cluster": {"worker": workers},
+                                     "task": {"type": "worker", "index": index}}))
+    processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker",
+                                       "--threads", str(threads_per_worker),
+                                       "--results", results_path, *worker_args],
+                                      env=env))
+  return_codes = [process.wait() for process in processes]
+  if any(return_codes):
+    raise RuntimeError(f"Workers exited with codes: {return_codes}")
+  with open(results_path) as f:
+    return json.load(f)
+
+def run_worker(args):
+  """
+  Trains with train_model() on this worker's shard of the images and (on worker 0) saves the timing.
+  """
+  import numpy as np
+  import pandas as pd
+  import tensorflow as tf
+  from sklearn.model_selection import train_test_split
+
+  from notebook_loader import load_notebook
+
+  tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+  tf.config.threading.set_inter_op_parallelism_threads(args.threads)
+  # The strategy has to be created before any other TensorFlow work
+  strategy = tf.distribute.MultiWorkerMirroredStrategy()
+
+  labels_csv = pd.read_csv(args.labels)[:args.num_images]
+  unique_breeds = np.unique(pd.read_csv(args.labels)["breed"])
+  notebook = load_notebook(unique_breeds=unique_breeds, NUM_EPOCHS=args.epochs)
+
+  # The same filenames and labels as the notebook
+  filenames = [os.path.join(args.train_dir, fname + ".jpg") for fname in labels_csv["id"]]
+  breed_to_index = {breed: index for index, breed in enumerate(unique_breeds)}
+  y = np.array([breed_to_index[label] for label in labels_csv["breed"]], dtype=np.int32)
+  if not notebook.SPARSE_LABELS:
+    y = y[:, np.newaxis] == np.arange(len(unique_breeds))
+  notebook.x_train, notebook.x_val, notebook.y_train, notebook.y_val = train_test_split(filenames, y,
+                                                                                      test_size=0.2,
+                                                                                      random_state=42)
+  class TimedEarlyStopping(tf.keras.callbacks.EarlyStopping):
+    """
+    EarlyStopping which also times every epoch, so building the model and the datasets isn't counted.
+    """
+    def on_train_begin(self, logs=None):
+      super().on_train_begin(logs)
+      self.epoch_seconds = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+      super().on_epoch_begin(epoch, logs)
+      self.epoch_start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+      self.epoch_seconds.append(time.perf_counter() - self.epoch_start)
+      super().on_epoch_end(epoch, logs)
+
+  timer = TimedEarlyStopping(monitor="val_accuracy", patience=3)
+  notebook.early_stopping = timer
+  notebook.train_model(strategy)
+
+  if notebook.is_chief(strategy):
+    # The first epoch includes tracing the train step, so leave it out if there are more
+    epoch_seconds = timer.epoch_seconds[1:] or timer.epoch_seconds
+    with open(args.results, "w") as f:
+      json.dump({"workers": strategy.num_replicas_in_sync,
+                 "epochs": len(timer.epoch_seconds),
+                 "seconds": sum(timer.epoch_seconds),
+                 "first_epoch_seconds": timer.epoch_seconds[0],
+                 "images/sec": len(notebook.x_train) * len(epoch_seconds) / sum(epoch_seconds)}, f)
+
+def main():
+  parser = argparse.ArgumentParser(description="Multi-worker training on local processes.")
+  parser.add_argument("--num_workers", type=int, default=2)
+  parser.add_argument("--scaling", help="Comma separated worker counts to compare, e.g. 1,2,4")
+  parser.add_argument("--labels", default="drive/My Drive/Dog-vision/labels.csv")
+  parser.add_argument("--train_dir", default="/content/drive/My Drive/Dog-vision/train")
+  parser.add_argument("--num_images", type=int, default=None, help="Only use the first images (all by default)")
+  parser.add_argument("--epochs", type=int, default=3)
+  # Set by the launcher
+  parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+  parser.add_argument("--threads", type=int, default=0, help=argparse.SUPPRESS)
+  parser.add_argument("--results", help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.worker:
+    run_worker(args)
+    return
+
+  worker_args = ["--labels", args.labels, "--train_dir", args.train_dir, "--epochs", str(args.epochs)]
+  if args.num_images:
+    worker_args += ["--num_images", str(args.num_images)]
+  worker_counts = [int(count) for count in args.scaling.split(",")] if args.scaling else [args.num_workers]
+
+  results = []
+  with tempfile.TemporaryDirectory() as results_dir:
+    for num_workers in worker_counts:
+      print(f"Training with {num_workers} workers...")
+      results.append(launch_workers(num_workers, worker_args,
+                                    os.path.join(results_dir, f"{num_workers}-workers.json")))
+
+  # Scaling efficiency: speedup over the first run divided by how many times more workers it had
+  base = results[0]
+  print(f"{'workers':>8} {'images/sec':>11} {'speedup':>8} {'efficiency':>11}")
+  for result in results:
+    speedup = result["images/sec"] / base["images/sec"]
+    efficiency = speedup / (result["workers"] / base["workers"])
+    print(f"{result['workers']:>8} {result['images/sec']:>11.1f} {speedup:>8.2f} {efficiency:>11.0%}")
+
+if __name__ == "__main__":
+  main()